@@ -2,23 +2,399 @@ __author__ = 'Pablo Ramos Criado'
 __students__ = 'Ilya Istomin'
 
 from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut
+from geopy.exc import GeocoderTimedOut, GeocoderUnavailable, GeocoderRateLimited
 import time
-from typing import Generator, Any, Self
+from typing import Generator, Any, Self, Iterable
 from geojson import Point
 from pymongo.collection import Collection
 from pymongo.cursor import Cursor
+from pymongo.command_cursor import CommandCursor
+from pymongo import InsertOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from bson import ObjectId, Decimal128
+from bson.codec_options import CodecOptions, TypeCodec, TypeRegistry
 
 
 import json
 import pymongo
+from itertools import islice
 import yaml
+import bson
+import contextlib
+import csv
+import functools
+import gzip
+import hashlib
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import unicodedata
+import weakref
+import zlib
+from decimal import Decimal
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+class GeocodeCache:
+    """
+    Cache of geocoding results keyed by the normalized address.
+    Entries live in a SQLite file so every distinct address is resolved
+    only once across runs, with a bounded LRU in memory in front of it.
+    Addresses that could not be located are stored too (negative results).
+
+    Attributes
+    ----------
+    path : str
+    path of the SQLite file with the persisted entries
+    maxsize : int
+    maximum number of entries kept in memory
+    ttl : float | None
+    seconds after which an entry is considered expired, None to never expire
+    """
+
+    def __init__(self, path: str = "geocode_cache.sqlite", maxsize: int = 4096, ttl: float | None = None):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS geocode ("
+            "address TEXT PRIMARY KEY, longitude REAL, latitude REAL, created REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def normalize(address: str) -> str:
+        """
+        Normalizes an address so that case, accents, punctuation and
+        whitespace differences map to the same cache key.
+        """
+        address = unicodedata.normalize("NFKD", address)
+        address = "".join(char for char in address if not unicodedata.combining(char))
+        address = re.sub(r"[^\w\s]", " ", address.casefold())
+        return " ".join(address.split())
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, address: str) -> tuple[bool, tuple[float, float] | None]:
+        """
+        Looks up an address in the cache.
+
+        Returns
+        -------
+        tuple[bool, tuple[float, float] | None]
+        whether the address is cached and its (longitude, latitude),
+        None as coordinates for a cached negative result
+        """
+        key = self.normalize(address)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                entry = self._db.execute(
+                    "SELECT longitude, latitude, created FROM geocode WHERE address = ?", (key,)
+                ).fetchone()
+                if entry is None:
+                    return False, None
+                longitude, latitude, created = entry
+                entry = (None if longitude is None else (longitude, latitude), created)
+            coordinates, created = entry
+            if self._expired(created):
+                self._memory.pop(key, None)
+                return False, None
+            self._remember(key, entry)
+            return True, coordinates
+
+    def set(self, address: str, coordinates: tuple[float, float] | None) -> None:
+        """
+        Stores the (longitude, latitude) of an address, or None if the
+        address could not be located.
+        """
+        key = self.normalize(address)
+        created = time.time()
+        longitude, latitude = coordinates if coordinates is not None else (None, None)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO geocode (address, longitude, latitude, created) VALUES (?, ?, ?, ?)",
+                (key, longitude, latitude, created)
+            )
+            self._db.commit()
+            self._remember(key, (coordinates, created))
+
+    def _remember(self, key: str, entry: tuple) -> None:
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def close(self) -> None:
+        self._db.close()
+
+
+geocode_cache: GeocodeCache | None = None
+
+
+def get_geocode_cache() -> GeocodeCache:
+    """
+    Returns the geocode cache used by getLocationPoint, opening the
+    default one on first use. Assign a GeocodeCache to geocode_cache
+    to use a different file, size or TTL.
+    """
+    global geocode_cache
+    if geocode_cache is None:
+        geocode_cache = GeocodeCache()
+    return geocode_cache
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all the threads that call a rate limited API.
+
+    Attributes
+    ----------
+    rate : float
+    tokens added to the bucket per second
+    capacity : int
+    maximum number of tokens, i.e. the largest allowed burst
+    """
+
+    def __init__(self, rate: float = 1.0, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Blocks until a token is available and takes it.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# Nominatim allows a single request per second for the whole client
+geocoder = None
+geocoder_rate_limiter = RateLimiter(rate=1.0)
+
+
+def get_geocoder():
+    """
+    Returns the geocoder client shared by all lookups, creating the
+    Nominatim client on first use. Assign any object with a
+    geocode(address) method to geocoder to use another provider,
+    such as a GazetteerGeocoder.
+    """
+    import random
+    import string
+
+    global geocoder
+    if geocoder is None:
+        length = random.randint(5, 25)
+        # It is You need to provide a user_agent to use the API
+        # Use a random name for the user_agent
+        letters_array = ''.join([random.choice(string.ascii_letters) for _ in range(length)])
+        geocoder = Nominatim(user_agent=letters_array, timeout=10)
+    return geocoder
+
+
+GazetteerLocation = namedtuple("GazetteerLocation", ["longitude", "latitude"])
+
+
+class GazetteerGeocoder:
+    """
+    Offline geocoder that resolves addresses against a local gazetteer.
+    The gazetteer is a CSV file with the columns city, street, postcode,
+    longitude and latitude, where street and postcode may be empty.
+    Rows are indexed in hash maps by their normalized street and city,
+    postcode or city, and an address resolves to the most specific match.
+    Misses are sent to the fallback geocoder, if any.
+
+    Attributes
+    ----------
+    fallback : object
+    geocoder used for addresses missing from the gazetteer, None to
+    return None for them
+    fallback_rate_limiter : RateLimiter | None
+    rate limiter applied to the fallback geocoder calls
+    """
+
+    def __init__(self, path: str | None = None, fallback=None,
+                 fallback_rate_limiter: RateLimiter | None = geocoder_rate_limiter):
+        self.fallback = fallback
+        self.fallback_rate_limiter = fallback_rate_limiter
+        self._streets = {}
+        self._postcodes = {}
+        self._cities = {}
+        if path is not None:
+            self.load(path)
+
+    def load(self, path: str) -> None:
+        """
+        Adds all the rows of a gazetteer CSV file to the index.
+        """
+        with open(path, newline="", encoding="utf-8") as csv_file:
+            for row in csv.DictReader(csv_file):
+                self.add(row["city"], float(row["longitude"]), float(row["latitude"]),
+                         street=row.get("street"), postcode=row.get("postcode"))
+
+    def add(self, city: str, longitude: float, latitude: float,
+            street: str | None = None, postcode: str | None = None) -> None:
+        """
+        Adds a point to the index at the most specific level given.
+        """
+        location = GazetteerLocation(longitude, latitude)
+        city = self._strip_numbers(GeocodeCache.normalize(city))
+        if street:
+            self._streets[(self._strip_numbers(GeocodeCache.normalize(street)), city)] = location
+        elif postcode:
+            self._postcodes[GeocodeCache.normalize(postcode)] = location
+        else:
+            self._cities[city] = location
+
+    @staticmethod
+    def _strip_numbers(text: str) -> str:
+        # House numbers and postcodes are not part of street or city names
+        return " ".join(token for token in text.split() if not token.isdigit())
+
+    def lookup(self, address: str) -> GazetteerLocation | None:
+        """
+        Resolves an address using only the gazetteer.
+        """
+        parts = [GeocodeCache.normalize(part) for part in address.split(",")]
+        names = [self._strip_numbers(part) for part in parts]
+
+        cities = [name for name in reversed(names) if name in self._cities]
+        for city in cities or [name for name in reversed(names) if name]:
+            for name in names:
+                location = self._streets.get((name, city))
+                if location is not None:
+                    return location
+
+        for part in parts:
+            for token in part.split():
+                location = self._postcodes.get(token)
+                if location is not None:
+                    return location
+
+        return self._cities[cities[0]] if cities else None
+
+    def geocode(self, address: str) -> GazetteerLocation | None:
+        """
+        Resolves an address using the gazetteer and the fallback geocoder
+        for misses. Compatible with the geopy geocode method.
+        """
+        location = self.lookup(address)
+        if location is None and self.fallback is not None:
+            if self.fallback_rate_limiter is not None:
+                self.fallback_rate_limiter.acquire()
+            location = self.fallback.geocode(address)
+        return location
+
+
+def _geocode_with_backoff(provider, address: str, rate_limiter: RateLimiter | None,
+                          retries: int, backoff: float) -> tuple[float, float] | None:
+    import random
+
+    for attempt in range(retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            location = provider.geocode(address)
+        except (GeocoderTimedOut, GeocoderUnavailable, GeocoderRateLimited):
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            logger.warning("Geocoding of '%s' failed, retrying in %.1fs", address, delay)
+            time.sleep(delay + random.uniform(0, backoff))
+            continue
+        if location is None:
+            return None
+        return (location.longitude, location.latitude)
+
+
+def geocode_many(addresses: Iterable[str], provider=None, max_workers: int = 4,
+                 rate_limiter: RateLimiter | None = None, retries: int = 5,
+                 backoff: float = 1.0) -> dict[str, Point | None]:
+    """
+    Gets the coordinates of several addresses at once.
+    Addresses are deduplicated by their normalized form, looked up in the
+    geocode cache and the remaining ones are geocoded concurrently on a
+    thread pool. Failed requests are retried with exponential backoff.
+
+    Parameters
+    ----------
+    addresses : Iterable[str]
+    addresses to geocode, duplicates are only resolved once
+    provider : object
+    geocoder with a geocode(address) method returning an object with
+    latitude and longitude or None, the shared Nominatim client if not given
+    max_workers : int
+    number of concurrent lookups
+    rate_limiter : RateLimiter | None
+    limiter shared by the lookups, the Nominatim one for Nominatim providers
+    retries : int
+    number of retries of a lookup that timed out or was rejected
+    backoff : float
+    seconds to wait before the first retry, doubled on every retry
+    Returns
+    -------
+    dict[str, geojson.Point | None]
+    point of every address, None for addresses that could not be located
+    """
+    if provider is None:
+        provider = get_geocoder()
+    if rate_limiter is None and isinstance(provider, Nominatim):
+        rate_limiter = geocoder_rate_limiter
+
+    cache = get_geocode_cache()
+    keys = {address: cache.normalize(address) for address in addresses}
+    coordinates = {}
+    pending = {}
+    for address, key in keys.items():
+        if key in coordinates or key in pending:
+            continue
+        cached, value = cache.get(address)
+        if cached:
+            coordinates[key] = value
+        else:
+            pending[key] = address
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                key: executor.submit(_geocode_with_backoff, provider, address, rate_limiter, retries, backoff)
+                for key, address in pending.items()
+            }
+            for key, future in futures.items():
+                coordinates[key] = future.result()
+                cache.set(pending[key], coordinates[key])
+
+    return {
+        address: None if coordinates[key] is None else Point(coordinates[key])
+        for address, key in keys.items()
+    }
+
 
 def getLocationPoint(address: str) -> Point:
     """
     Gets the coordinates of an address in geojson.Point format
     Use the geopy API to get the coordinates of the address
-    Be careful, the API is public and has a request limit, use sleeps.
+    Be careful, the API is public and has a request limit, the shared
+    rate limiter of geocode_many takes care of it.
 
     Parameters
     ----------
@@ -29,46 +405,32 @@ def getLocationPoint(address: str) -> Point:
     geojson.Point
     coordinates of the point of the address
     """
-    import random
-    import string
+    point = geocode_many([address])[address]
+    if point is None:
+        raise ValueError('Location not found')
+    return point
 
-    location = None
-    while location is None:
-        length = random.randint(5, 25)
-    
-        letters_array = ''.join([random.choice(string.ascii_letters) for _ in range(length)])
 
-        location = None
-        geolocator = Nominatim(user_agent=letters_array)
-        try:
-            time.sleep(1)
-            #DONE
-            # It is You need to provide a user_agent to use the API
-            # Use a random name for the user_agent
-            location = geolocator.geocode(address)
-        except GeocoderTimedOut:
-            # May throw an exception if the timeout occurs
-            # Try again
-            print("GeocoderTimedOut: Retrying...")
-        
-    #DONE
-    if location:
-        point = Point((location.longitude, location.latitude))
-        return point
-    else:
+def point_to_dict(point: Point | None) -> dict:
+    #func for transforming geoLocation to dict
+    if point is None:
         raise ValueError('Location not found')
-        
+    return {"longitude": point['coordinates'][0], "latitude": point['coordinates'][1]}
+
+
 def get_coordinates_as_dict(address: str) -> dict:
-    #func for transforming geoLocation to dict
-    location_point = getLocationPoint(address)
-    return {"longitude": location_point['coordinates'][0], "latitude": location_point['coordinates'][1]}
+    return point_to_dict(getLocationPoint(address))
     
 
 
 
-def export_collection_to_json(collection: Collection, file_name: str) -> None:
+def export_collection_to_json(collection: Collection, file_name: str, filter: dict | None = None,
+                              projection: dict | list | None = None, format: str | None = None,
+                              compress: bool | None = None, batch_size: int = 1000) -> int:
     """
     Exports a MongoDB collection to a JSON file.
+    The documents are streamed from the cursor and written in chunks,
+    so memory usage does not depend on the size of the collection.
     
     Parameters
     ----------
@@ -76,16 +438,73 @@ def export_collection_to_json(collection: Collection, file_name: str) -> None:
         MongoDB collection to export.
     file_name : str
         Name of the file to export to.
+    filter : dict | None
+        Query filter of the documents to export, all of them if None.
+    projection : dict | list | None
+        Fields to export, all of them if None.
+    format : str | None
+        "json" for a JSON array or "ndjson" for one document per line,
+        if None it is "ndjson" for .ndjson/.jsonl files and "json" otherwise.
+    compress : bool | None
+        Whether to gzip the output, if None only .gz files are compressed.
+    batch_size : int
+        Number of documents read and written at a time.
+    Returns
+    -------
+    int
+        Number of exported documents.
     """
-    cursor = collection.find({})
-    data = list(cursor)
-    # Change ObjectId to string for export purposes
-    for document in data:
-        if "_id" in document:
-            document["_id"] = str(document["_id"])
-    
-    with open(file_name, "w") as json_file:
-        json.dump(data, json_file, indent=4)
+    base_name = file_name[:-3] if file_name.endswith(".gz") else file_name
+    if format is None:
+        format = "ndjson" if base_name.endswith((".ndjson", ".jsonl")) else "json"
+    if format not in ("json", "ndjson"):
+        raise ValueError(f"Unsupported export format: {format}")
+    if compress is None:
+        compress = file_name.endswith(".gz")
+
+    cursor = collection.find(filter or {}, projection, batch_size=batch_size)
+    documents = iter(cursor)
+    count = 0
+    opener = gzip.open if compress else open
+    with opener(file_name, "wt", encoding="utf-8") as json_file:
+        if format == "json":
+            json_file.write("[")
+        # ObjectId and other BSON types are exported as strings
+        while batch := list(islice(documents, batch_size)):
+            lines = [json.dumps(document, default=str) for document in batch]
+            if format == "json":
+                json_file.write((",\n" if count else "") + ",\n".join(lines))
+            else:
+                json_file.write("\n".join(lines) + "\n")
+            count += len(batch)
+        if format == "json":
+            json_file.write("]\n")
+    return count
+
+
+def export_collections_to_json(exports: list[tuple[Collection, str]], max_workers: int = 4, **options) -> dict[str, int]:
+    """
+    Exports several collections concurrently, one thread per collection.
+
+    Parameters
+    ----------
+    exports : list[tuple[Collection, str]]
+        Collections to export and the file to export each one to.
+    max_workers : int
+        Maximum number of collections exported at the same time.
+    options
+        Options passed to export_collection_to_json.
+    Returns
+    -------
+    dict[str, int]
+        Number of exported documents per file.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            file_name: executor.submit(export_collection_to_json, collection, file_name, **options)
+            for collection, file_name in exports
+        }
+        return {file_name: future.result() for file_name, future in futures.items()}
 
 
 def load_data_from_json(filename="data.json"):
@@ -93,6 +512,831 @@ def load_data_from_json(filename="data.json"):
         return json.load(json_file)
 
 
+class _JSONStream:
+    """
+    Reads JSON values one at a time from a file that is read in chunks.
+    """
+
+    def __init__(self, file, chunk_size: int):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> None:
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self) -> str:
+        """
+        Skips whitespace and returns the next character, "" at the end of the file.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self._fill()
+
+    def take(self, expected: str) -> str:
+        char = self.peek()
+        if char not in expected or not char:
+            raise ValueError(f"Invalid JSON: expected one of '{expected}' at '{char}'")
+        self.pos += 1
+        return char
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number cut at the end of the buffer may continue in the next chunk
+                if self.eof or (end < len(self.buffer) and self.buffer[end] not in "0123456789.eE+-"):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+def iter_json_arrays(filename: str = "data.json", batch_size: int = 1000,
+                     chunk_size: int = 1 << 16) -> Generator[tuple[str, list], None, None]:
+    """
+    Parses a JSON file whose top level is an object of arrays, like
+    data.json, without loading it in memory. Yields the elements of every
+    array in batches, together with the key of the array. Values that are
+    not arrays are skipped.
+
+    Parameters
+    ----------
+    filename : str
+    path of the JSON file
+    batch_size : int
+    maximum number of elements per batch
+    chunk_size : int
+    number of characters read from the file at a time
+    """
+    with open(filename, "r", encoding="utf-8") as json_file:
+        stream = _JSONStream(json_file, chunk_size)
+        stream.take("{")
+        if stream.peek() == "}":
+            return
+        while True:
+            key = stream.value()
+            stream.take(":")
+            if stream.peek() != "[":
+                stream.value()
+            else:
+                stream.take("[")
+                batch = []
+                if stream.peek() == "]":
+                    stream.take("]")
+                else:
+                    while True:
+                        batch.append(stream.value())
+                        if len(batch) == batch_size:
+                            yield key, batch
+                            batch = []
+                        if stream.take(",]") == "]":
+                            break
+                if batch:
+                    yield key, batch
+            if stream.take(",}") == "}":
+                return
+
+
+class ImportCheckpoint:
+    """
+    Number of records of every collection already imported from a file,
+    persisted after each batch so that a failed import can resume.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with open(path, "r") as checkpoint_file:
+                self.done = json.load(checkpoint_file)
+        except FileNotFoundError:
+            self.done = {}
+
+    def update(self, key: str, count: int) -> None:
+        self.done[key] = self.done.get(key, 0) + count
+        # Written to a temporary file first so a crash never leaves it half written
+        with open(self.path + ".tmp", "w") as checkpoint_file:
+            json.dump(self.done, checkpoint_file)
+        os.replace(self.path + ".tmp", self.path)
+
+    def remove(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _import_id(filename: str, key: str, offset: int) -> ObjectId:
+    # The same record of the same file always gets the same id
+    digest = hashlib.sha1(f"{os.path.basename(filename)}:{key}:{offset}".encode()).digest()
+    return ObjectId(digest[:12])
+
+
+def _insert_batch(models: list, ids: list[ObjectId]) -> None:
+    """
+    Inserts the models of an import batch with their ids, ignoring the
+    ones already inserted by a previous run of the same import.
+    """
+    documents = [{**model.to_document(), "_id": id} for model, id in zip(models, ids)]
+    try:
+        type(models[0]).db.insert_many(documents, ordered=False)
+    except BulkWriteError as error:
+        # Only duplicates of the _id are records already imported, other unique indexes are real errors
+        if not all(_duplicate_id(write_error) for write_error in error.details["writeErrors"]):
+            raise
+
+
+def _duplicate_id(write_error: dict) -> bool:
+    if write_error["code"] != 11000:
+        return False
+    if "keyPattern" in write_error:
+        return write_error["keyPattern"] == {"_id": 1}
+    # Servers that do not return the key pattern name the index in the message
+    return " index: _id_ " in write_error.get("errmsg", "")
+
+
+def import_json_file(filename: str, loaders: dict, checkpoint_path: str | None = None,
+                     batch_size: int = 1000) -> dict[str, int]:
+    """
+    Imports the arrays of a JSON file like data.json into the database.
+    Records are read incrementally in batches, every batch is turned into
+    models by the loader of its array, which validates and enriches them
+    (e.g. geocoding), and saved with a single bulk write. Every record gets
+    an id computed from the file name, its array and its position, so
+    importing a batch again never duplicates it.
+
+    Parameters
+    ----------
+    filename : str
+    path of the JSON file
+    loaders : dict[str, Callable[[list[dict]], list[Model]]]
+    function that builds the models of a batch, for every array to import.
+    Arrays without a loader are skipped
+    checkpoint_path : str | None
+    file where the progress is saved. If the import fails, running it again
+    skips the records already imported. Removed when the import finishes
+    batch_size : int
+    number of records per batch
+    Returns
+    -------
+    dict[str, int]
+    number of records imported per array in this run
+    """
+    checkpoint = ImportCheckpoint(checkpoint_path) if checkpoint_path else None
+    imported = {key: 0 for key in loaders}
+    seen = {key: 0 for key in loaders}
+
+    for key, records in iter_json_arrays(filename, batch_size):
+        if key not in loaders:
+            continue
+        # Skip the records imported by a previous run
+        skip = (checkpoint.done.get(key, 0) if checkpoint else 0) - seen[key]
+        seen[key] += len(records)
+        if skip >= len(records):
+            continue
+        records = records[max(skip, 0):]
+
+        models = loaders[key](records)
+        if models:
+            first = seen[key] - len(records)
+            ids = [_import_id(filename, key, first + position) for position in range(len(models))]
+            _insert_batch(models, ids)
+        # Saved right after the write: a run that fails before only inserts the batch again
+        if checkpoint:
+            checkpoint.update(key, len(records))
+        if models:
+            model_class = type(models[0])
+            for model, id in zip(models, ids):
+                model._id = str(id)
+                model._dirty.clear()
+            model_class.invalidate_cache_for_ids([model._id for model in models],
+                                                 set().union(*(model.to_document() for model in models)))
+        imported[key] += len(records)
+        logger.info("Imported %d records of %s", imported[key], key)
+
+    if checkpoint:
+        checkpoint.remove()
+    return imported
+
+
+
+
+logger = logging.getLogger("ODM")
+
+# Marks a field that is not set in a model
+_MISSING = object()
+
+# Document counts and indexed fields of the collections, see Model._collection_info:
+# (database, collection, info) -> (expiration time, value)
+_collection_info: dict[tuple[str, str, str], tuple[float, Any]] = {}
+
+# Index options compared by ensure_indexes even when they are not declared
+_INDEX_OPTION_DEFAULTS = {"unique": False, "sparse": False, "expireAfterSeconds": None, "partialFilterExpression": None}
+
+
+def _pipeline_collections(pipeline: list[dict]) -> set[str]:
+    """
+    Returns the collections read by the $lookup, $graphLookup and
+    $unionWith stages of a pipeline, including nested pipelines.
+    """
+    collections = set()
+    for stage in pipeline:
+        for stage_name, spec in stage.items():
+            if stage_name in ("$lookup", "$graphLookup"):
+                if "from" in spec:
+                    collections.add(spec["from"])
+                collections |= _pipeline_collections(spec.get("pipeline", []))
+            elif stage_name == "$unionWith":
+                if isinstance(spec, str):
+                    collections.add(spec)
+                else:
+                    collections.add(spec["coll"])
+                    collections |= _pipeline_collections(spec.get("pipeline", []))
+            elif stage_name == "$facet":
+                for sub_pipeline in spec.values():
+                    collections |= _pipeline_collections(sub_pipeline)
+    return collections
+
+
+def _explain_summary(explain: dict) -> dict:
+    """
+    Extracts the documents and keys examined and the indexes used
+    from the output of explain, wherever they are nested.
+    """
+    summary = {"docs_examined": 0, "keys_examined": 0, "indexes": set()}
+
+    def visit(node) -> None:
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == "totalDocsExamined":
+                    summary["docs_examined"] += value
+                elif key == "totalKeysExamined":
+                    summary["keys_examined"] += value
+                elif key == "indexName":
+                    summary["indexes"].add(value)
+                elif key != "rejectedPlans":
+                    visit(value)
+        elif isinstance(node, list):
+            for item in node:
+                visit(item)
+
+    visit(explain)
+    summary["indexes"] = sorted(summary["indexes"])
+    return summary
+
+
+def _pipeline_lookups(pipeline: list[dict]) -> Generator[dict, None, None]:
+    """
+    Yields the specification of every $lookup stage of a pipeline,
+    including nested pipelines.
+    """
+    for stage in pipeline:
+        for stage_name, spec in stage.items():
+            if stage_name == "$lookup":
+                yield spec
+                yield from _pipeline_lookups(spec.get("pipeline", []))
+            elif stage_name == "$facet":
+                for sub_pipeline in spec.values():
+                    yield from _pipeline_lookups(sub_pipeline)
+
+
+def _match_fields(condition: dict) -> set[str] | None:
+    """
+    Returns the fields read by a $match condition, or None if they
+    cannot be known (operators such as $expr, $where or $text).
+    """
+    fields = set()
+    for key, value in condition.items():
+        if key in ("$and", "$or", "$nor"):
+            for sub_condition in value:
+                sub_fields = _match_fields(sub_condition)
+                if sub_fields is None:
+                    return None
+                fields |= sub_fields
+        elif key.startswith("$"):
+            return None
+        else:
+            fields.add(key)
+    return fields
+
+
+def _join_outputs(stage: dict) -> set[str] | None:
+    """
+    Returns the fields written by a $lookup or $unwind stage, or None
+    for any other stage.
+    """
+    if "$lookup" in stage:
+        return {stage["$lookup"]["as"]}
+    if "$unwind" in stage:
+        spec = stage["$unwind"]
+        if isinstance(spec, str):
+            return {spec[1:]}
+        outputs = {spec["path"][1:]}
+        if "includeArrayIndex" in spec:
+            outputs.add(spec["includeArrayIndex"])
+        return outputs
+    return None
+
+
+def _field_references(node: Any, name: str) -> set[str]:
+    """
+    Returns the top-level subfields of name referenced anywhere in node,
+    as field paths or $-prefixed expressions. An empty string in the
+    result means that name is used as a whole.
+    """
+    references = set()
+    if isinstance(node, dict):
+        for key, value in node.items():
+            references |= _field_references(key, name) | _field_references(value, name)
+    elif isinstance(node, list):
+        for item in node:
+            references |= _field_references(item, name)
+    elif isinstance(node, str):
+        if node.startswith(("$$ROOT", "$$CURRENT")):
+            references.add("")
+        path = node[1:] if node.startswith("$") else node
+        if path == name:
+            references.add("")
+        elif path.startswith(name + "."):
+            references.add(path[len(name) + 1:].split(".")[0])
+    return references
+
+
+def _reshapes(stage: dict) -> bool:
+    """
+    Returns whether a stage builds new documents that only keep the
+    fields it names: $group, $count, $replaceRoot and inclusion $project.
+    """
+    if any(stage_name in stage for stage_name in ("$group", "$count", "$replaceRoot", "$replaceWith", "$sortByCount")):
+        return True
+    projection = stage.get("$project")
+    if projection is None:
+        return False
+    return all(value not in (0, False) for field, value in projection.items() if field != "_id")
+
+
+def optimize_pipeline(pipeline: list[dict]) -> list[dict]:
+    """
+    Returns an equivalent pipeline that joins less data:
+    - $match stages are moved ahead of the $lookup and $unwind stages
+    whose fields they do not read, so fewer documents are joined.
+    - a $lookup followed by an $unwind of its result only fetches the
+    fields of the joined documents read by the later stages, with a
+    $project in the lookup pipeline (needs MongoDB 5.0). This is only
+    done when a later stage ($group, an inclusion $project...) rebuilds
+    the documents, otherwise the joined documents are in the result.
+    The given pipeline is not modified.
+    """
+    pipeline = list(pipeline)
+
+    moved = True
+    while moved:
+        moved = False
+        for i in range(1, len(pipeline)):
+            if list(pipeline[i]) != ["$match"]:
+                continue
+            outputs = _join_outputs(pipeline[i - 1])
+            fields = _match_fields(pipeline[i]["$match"])
+            if outputs is None or fields is None:
+                continue
+            if any(field == output or field.startswith(output + ".") or output.startswith(field + ".")
+                   for field in fields for output in outputs):
+                continue
+            pipeline[i - 1], pipeline[i] = pipeline[i], pipeline[i - 1]
+            moved = True
+
+    for i in range(len(pipeline) - 1):
+        lookup = pipeline[i].get("$lookup")
+        if lookup is None or "localField" not in lookup or "pipeline" in lookup:
+            continue
+        unwind = pipeline[i + 1].get("$unwind")
+        if (unwind if isinstance(unwind, str) else (unwind or {}).get("path")) != "$" + lookup["as"]:
+            continue
+        # The joined documents reach the output unless a later stage rebuilds the documents
+        barrier = next((position for position in range(i + 2, len(pipeline)) if _reshapes(pipeline[position])), None)
+        if barrier is None or any("$facet" in stage for stage in pipeline[i + 2:barrier]):
+            continue
+        subfields = _field_references(pipeline[i + 2:barrier + 1], lookup["as"])
+        if "" in subfields:
+            continue
+        # An empty projection would exclude _id and keep everything else
+        projection = {field: 1 for field in sorted(subfields)} or {"_id": 1}
+        if "_id" not in projection:
+            projection["_id"] = 0
+        pipeline[i] = {"$lookup": {**lookup, "pipeline": [{"$project": projection}]}}
+    return pipeline
+
+
+class QueryProfiler:
+    """
+    Collects per model statistics of the ODM operations and logs the
+    slow ones to the "ODM.slow" logger.
+
+    Attributes
+    ----------
+    threshold_ms : float
+    operations taking at least this many milliseconds are logged as slow
+    explain_sample_rate : float
+    fraction of the find, find_by_id and aggregate calls that are also
+    explained to record the documents examined and the indexes used
+    """
+
+    def __init__(self, threshold_ms: float = 100, explain_sample_rate: float = 0.0, slow_log_path: str | None = None):
+        self.threshold_ms = threshold_ms
+        self.explain_sample_rate = explain_sample_rate
+        self.slow_logger = logging.getLogger("ODM.slow")
+        # Removed by close, so that profilers enabled again do not add handlers
+        self._handler = None
+        if slow_log_path is not None:
+            self._handler = logging.FileHandler(slow_log_path)
+            self._handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.slow_logger.addHandler(self._handler)
+            self.slow_logger.setLevel(logging.INFO)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        """
+        Removes and closes the file handler of the slow log, if any.
+        """
+        if self._handler is not None:
+            self.slow_logger.removeHandler(self._handler)
+            self._handler.close()
+            self._handler = None
+
+    def record(self, model: type, operation: str, seconds: float, result: Any, args: tuple, kwargs: dict) -> None:
+        """
+        Records one call of an operation of a model.
+        """
+        import random
+
+        if isinstance(result, list):
+            documents = len(result)
+        elif isinstance(result, dict):
+            documents = 1
+        elif isinstance(result, int) and not isinstance(result, bool):
+            # Documents modified or deleted by the bulk operations
+            documents = result
+        elif result is None and operation == "find_by_id":
+            documents = 0
+        else:
+            documents = None
+
+        explain = None
+        if operation in ("find", "find_by_id", "aggregate") and random.random() < self.explain_sample_rate:
+            try:
+                explain = _explain_summary(model.explain(operation, *args, **kwargs))
+            except Exception as error:
+                logger.warning("Could not explain %s.%s: %s", model.__name__, operation, error)
+
+        elapsed_ms = seconds * 1000
+        with self._lock:
+            stats = self._stats.setdefault(model.__name__, {}).setdefault(operation, {
+                "calls": 0, "total_ms": 0.0, "max_ms": 0.0, "documents": 0, "slow_calls": 0, "last_explain": None
+            })
+            stats["calls"] += 1
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            stats["documents"] += documents or 0
+            if explain is not None:
+                stats["last_explain"] = explain
+            if elapsed_ms >= self.threshold_ms:
+                stats["slow_calls"] += 1
+
+        if elapsed_ms >= self.threshold_ms:
+            self.slow_logger.warning(
+                "%s.%s took %.1f ms, %s documents, args=%s kwargs=%s explain=%s",
+                model.__name__, operation, elapsed_ms, documents, args, kwargs, explain
+            )
+
+    def stats(self, model_name: str | None = None) -> dict:
+        """
+        Returns a copy of the statistics of a model, or of all the models
+        keyed by model name if no name is given.
+        """
+        with self._lock:
+            if model_name is not None:
+                return {operation: dict(stats) for operation, stats in self._stats.get(model_name, {}).items()}
+            return {name: {operation: dict(stats) for operation, stats in operations.items()}
+                    for name, operations in self._stats.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+
+def _profiled(operation: str):
+    """
+    Decorates a Model method so that its calls are recorded by the
+    profiler of the model, if profiling is enabled.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self_or_cls, *args, **kwargs):
+            profiler = self_or_cls.profiler
+            if profiler is None:
+                return method(self_or_cls, *args, **kwargs)
+            start = time.perf_counter()
+            result = method(self_or_cls, *args, **kwargs)
+            model = self_or_cls if isinstance(self_or_cls, type) else type(self_or_cls)
+            profiler.record(model, operation, time.perf_counter() - start, result, args, kwargs)
+            return result
+        return wrapper
+    return decorator
+
+
+class JSONCodec:
+    """
+    Encoding of the cached values used before BSONCodec. ObjectIds,
+    datetimes and other types unknown to JSON are stored as strings, so
+    cached results do not have the same types as the database ones.
+    """
+
+    def encode(self, value: Any) -> bytes:
+        return json.dumps(value, default=str).encode()
+
+    def decode(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class _DecimalCodec(TypeCodec):
+    # BSON has no Python Decimal, it is stored as Decimal128
+    python_type = Decimal
+    bson_type = Decimal128
+
+    def transform_python(self, value: Decimal) -> Decimal128:
+        return Decimal128(value)
+
+    def transform_bson(self, value: Decimal128) -> Decimal:
+        return value.to_decimal()
+
+
+class BSONCodec:
+    """
+    Encoding of the cached values with BSON, the format of the documents
+    in MongoDB, so ObjectIds, datetimes (with millisecond precision, as
+    MongoDB stores them) and Decimals are read back with their type.
+    Values larger than compress_threshold bytes are compressed with zlib.
+    Values written by JSONCodec are still decoded.
+
+    Attributes
+    ----------
+    compress_threshold : int | None
+    size in bytes above which values are compressed, None to never compress
+    compress_level : int
+    zlib compression level
+    """
+    # First byte of the encoded values, JSON values never start with them
+    RAW = b"\x00"
+    COMPRESSED = b"\x01"
+
+    codec_options = CodecOptions(type_registry=TypeRegistry([_DecimalCodec()]))
+
+    def __init__(self, compress_threshold: int | None = 16 * 1024, compress_level: int = 1):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def encode(self, value: Any) -> bytes:
+        # BSON documents are mappings, lists of results are wrapped
+        data = bson.encode({"v": value}, codec_options=self.codec_options)
+        if self.compress_threshold is not None and len(data) > self.compress_threshold:
+            return self.COMPRESSED + zlib.compress(data, self.compress_level)
+        return self.RAW + data
+
+    def decode(self, data: bytes) -> Any:
+        marker, payload = data[:1], data[1:]
+        if marker == self.COMPRESSED:
+            payload = zlib.decompress(payload)
+        elif marker != self.RAW:
+            return json.loads(data)
+        return bson.decode(payload, codec_options=self.codec_options)["v"]
+
+
+# Sets cached values only if the version of the collection is still the one
+# read before querying MongoDB, so a fill never overwrites an invalidation
+# that happened meanwhile. The first cached key is also added to the index
+# sets that follow the cached keys, and the last ones (field indexes) expire.
+# KEYS: version, cached keys..., index sets...
+# ARGV: expected version, ttl, number of cached keys, values..., number of
+# index sets that expire, their ttl
+_FILL_SCRIPT = """
+local version = redis.call('GET', KEYS[1]) or '0'
+if version ~= ARGV[1] then
+    return 0
+end
+local count = tonumber(ARGV[3])
+for i = 1, count do
+    redis.call('SET', KEYS[i + 1], ARGV[i + 3], 'EX', ARGV[2])
+end
+local expiring = tonumber(ARGV[count + 4])
+for i = count + 2, #KEYS do
+    redis.call('SADD', KEYS[i], KEYS[2])
+    if i > #KEYS - expiring then
+        redis.call('EXPIRE', KEYS[i], ARGV[count + 5])
+    end
+end
+return 1
+"""
+
+# Deletes the cached queries listed in the index sets, the index sets and the
+# cached documents, increments the version of the collection, records the
+# ids in the change sets of the materialized views listed in the views set
+# of the collection and publishes the version key so that local caches drop
+# the collection, atomically.
+# KEYS: index sets..., version, cached documents..., views set
+# ARGV: number of index sets, number of cached documents, channel, ids...
+_INVALIDATE_SCRIPT = """
+local function delete(keys)
+    local removed = 0
+    for i = 1, #keys, 1000 do
+        removed = removed + redis.call('DEL', unpack(keys, i, math.min(i + 999, #keys)))
+    end
+    return removed
+end
+local indexes, documents = tonumber(ARGV[1]), tonumber(ARGV[2])
+local removed = 0
+local keys = {}
+for i = 1, indexes do
+    removed = removed + delete(redis.call('SMEMBERS', KEYS[i]))
+    keys[#keys + 1] = KEYS[i]
+end
+for i = indexes + 2, indexes + 1 + documents do
+    keys[#keys + 1] = KEYS[i]
+end
+delete(keys)
+redis.call('INCR', KEYS[indexes + 1])
+for _, changes in ipairs(redis.call('SMEMBERS', KEYS[#KEYS])) do
+    for j = 4, #ARGV, 1000 do
+        redis.call('SADD', changes, unpack(ARGV, j, math.min(j + 999, #ARGV)))
+    end
+end
+redis.call('PUBLISH', ARGV[3], KEYS[indexes + 1])
+return removed
+"""
+
+# Deletes a lock only if it is still held with the token of the caller, so
+# a lock that expired and was taken by another caller is not released.
+# KEYS: lock
+# ARGV: token
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Channel where invalidations publish the version key of the collection
+INVALIDATION_CHANNEL = "odm:invalidations"
+
+# Scripts registered on each cache client, they are sent by SHA after the first call
+_cache_scripts: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+# Threads refreshing the stale find results in the background, see Model.find
+_refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="odm-refresh")
+
+
+class LocalCache:
+    """
+    In-process LRU cache with expiration in front of Redis, for the
+    results of find and find_by_id. Entries are grouped by collection
+    and every invalidation, from any process, publishes the collection
+    on INVALIDATION_CHANNEL so that all the local caches drop its entries.
+    A background thread listens to the channel. If the connection is
+    lost, the whole cache is dropped, since messages may have been missed.
+    Cached values are shared between callers and must not be modified.
+
+    Attributes
+    ----------
+    cache : redis.Redis
+    Redis client used to subscribe to the invalidations
+    maxsize : int
+    maximum number of entries
+    ttl : float
+    seconds an entry is kept, which also bounds the staleness if a
+    message is lost
+    """
+
+    def __init__(self, cache, maxsize: int = 10_000, ttl: float = 60.0, channel: str = INVALIDATION_CHANNEL):
+        self.cache = cache
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.channel = channel
+        self._entries = OrderedDict()
+        # Incremented on every invalidation, values read before are not stored
+        self._epoch = 0
+        self._generations: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._listener = threading.Thread(target=self._listen, name="ODM local cache", daemon=True)
+        self._listener.start()
+
+    def generation(self, namespace: str) -> tuple[int, int]:
+        """
+        Returns the invalidation count of a collection, to pass to set.
+        """
+        with self._lock:
+            return self._epoch, self._generations.get(namespace, 0)
+
+    def get(self, namespace: str, key: str) -> Any:
+        """
+        Returns the cached value, or _MISSING if it is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is None:
+                return _MISSING
+            value, created = entry
+            if time.monotonic() - created > self.ttl:
+                del self._entries[(namespace, key)]
+                return _MISSING
+            self._entries.move_to_end((namespace, key))
+            return value
+
+    def set(self, namespace: str, key: str, value: Any, generation: tuple[int, int]) -> None:
+        """
+        Caches a value read when the collection had the given generation,
+        unless it was invalidated since.
+        """
+        with self._lock:
+            if (self._epoch, self._generations.get(namespace, 0)) != generation:
+                return
+            self._entries[(namespace, key)] = (value, time.monotonic())
+            self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, namespace: str | None = None) -> None:
+        """
+        Drops the entries of a collection, or all of them.
+        """
+        with self._lock:
+            if namespace is None:
+                self._entries.clear()
+                self._epoch += 1
+                return
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+            for entry_key in [entry_key for entry_key in self._entries if entry_key[0] == namespace]:
+                del self._entries[entry_key]
+
+    def close(self) -> None:
+        self._closed.set()
+
+    def _listen(self) -> None:
+        while not self._closed.is_set():
+            try:
+                pubsub = self.cache.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # Messages published before subscribing were missed
+                self.invalidate()
+                while not self._closed.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        data = message["data"]
+                        self.invalidate(data.decode() if isinstance(data, bytes) else data)
+                pubsub.close()
+            except Exception as error:
+                logger.warning("Local cache lost the invalidation channel: %s", error)
+                self.invalidate()
+                self._closed.wait(1.0)
+
+
+def _normalize_id(id: Any) -> Any:
+    """
+    Returns the id as stored in MongoDB: models keep the ObjectIds
+    generated by the database as strings, they are converted back.
+    """
+    if isinstance(id, str) and ObjectId.is_valid(id):
+        return ObjectId(id)
+    return id
+
+
+def _filter_fields(filter: dict) -> set[str]:
+    """
+    Returns the top level fields a query filter depends on.
+    "*" is returned for filters that may depend on any field.
+    """
+    fields = set()
+    for key, value in filter.items():
+        if key in ("$and", "$or", "$nor"):
+            for condition in value:
+                fields |= _filter_fields(condition)
+        elif key.startswith("$"):
+            # $expr, $where, $text... can read any field
+            fields.add("*")
+        else:
+            fields.add(key.split(".")[0])
+    return fields or {"*"}
 
 
 class Model:
@@ -100,8 +1344,39 @@ class Model:
     Abstract model class
     Create as many classes that inherit from this class as
     collections/models you want to have in the database.
+    Assignments to the fields are tracked so that save() only sends
+    the fields that changed. In-place changes of mutable values are not
+    tracked, assign the value again to mark the field as modified.
+    Models built with an _id, e.g. Model(**document), send all their
+    fields on their first save, the models read by the ODM only the
+    modified ones.
     """
+    # Subclasses get a __dict__ unless they declare their own __slots__
+    __slots__ = ()
     cache = None
+    # In-process cache in front of Redis, see enable_local_cache
+    local_cache: LocalCache | None = None
+    # Encoding of the documents stored in the cache
+    codec: BSONCodec | JSONCodec = BSONCodec()
+    # Seconds an expired find result is still served while one caller refreshes it
+    stale_ttl: int = 60
+    # Expiration of the lock of the caller recomputing a find result, in seconds
+    lock_timeout: float = 5.0
+    # Seconds find_by_id remembers that an id does not exist
+    negative_ttl: int = 30
+    profiler: QueryProfiler | None = None
+    # Documents sampled per partition to compute the ranges of parallel_scan
+    partition_sample: int = 100
+    # Optimized aggregates with blocking stages may spill to disk above this size
+    disk_use_threshold: int = 100_000
+    # Seconds the document counts and indexes read by optimized aggregates are reused
+    collection_info_ttl: float = 300.0
+    # Fields holding names of other models: field -> (model class, key field)
+    references: dict[str, tuple[type, str]] = {}
+    required_vars: frozenset[str] = frozenset()
+    admissible_vars: frozenset[str] = frozenset()
+    # Precomputed by init_class so instances do not build sets
+    _allowed_vars: frozenset[str] = frozenset({"_id"})
 
     def __init__(self, **kwargs):
         """
@@ -109,135 +1384,1768 @@ class Model:
         Checks that the values are supported by the model and
         that the required variables are provided.
         """
-        allowed_vars = self.required_vars | self.admissible_vars | {"_id"}
+        self._check_fields(kwargs)
+
+        # Assign all the values in kwargs to the instance attributes
+        self.__dict__.update(kwargs)
+        # Fields modified since the model was loaded or last saved. A model built
+        # with an _id, e.g. Model(**document) with changed values, saves every field
+        self.__dict__["_dirty"] = set(kwargs) - {"_id"} if "_id" in kwargs else set()
+
+    @classmethod
+    def _check_fields(cls, kwargs: dict) -> None:
+        # Comparing the key view against the frozen sets avoids building new sets
+        keys = kwargs.keys()
+        if not keys >= cls.required_vars:
+            raise ValueError(f"Missing required variables: {set(cls.required_vars - keys)}")
+        if not keys <= cls._allowed_vars:
+            raise ValueError(f"Invalid fields provided: {set(keys - cls._allowed_vars)}")
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        """
+        Checks that the field is supported by the model and marks it
+        as modified if its value changes.
+        """
+        if name not in self._allowed_vars:
+            raise ValueError(f"Invalid field provided: {name}")
+
+        if name != "_id" and self.__dict__.get(name, _MISSING) != value:
+            self._dirty.add(name)
+        self.__dict__[name] = value
+
+    def __delattr__(self, name: str) -> None:
+        """
+        Removes an admissible field, it is unset on the next save.
+        """
+        if name in self.required_vars or name == "_id":
+            raise ValueError(f"Cannot remove required field: {name}")
+        del self.__dict__[name]
+        self._dirty.add(name)
+
+    def to_document(self) -> dict:
+        """
+        Returns the model fields as a MongoDB document.
+        """
+        return {key: value for key, value in self.__dict__.items() if key == "_id" or not key.startswith("_")}
+
+    def ref(self, field: str) -> "Model | list[Model | None] | None":
+        """
+        Returns the model referenced by a field, or the list of models if
+        the field holds a list of names. The references of models loaded
+        together (see ModelCursor.resolve_references) are fetched together,
+        with one query per referenced model.
+        """
+        if field not in self.references:
+            raise ValueError(f"Field {field} is not a reference")
+        page = getattr(self, "_refs", None)
+        if page is None:
+            page = ReferenceLoader().attach([self])
+        return page.resolve(self, field)
+
+    def _changes(self) -> dict:
+        """
+        Returns the update with the modified fields, empty if nothing changed.
+        """
+        changes = {}
+        for name in self._dirty:
+            value = getattr(self, name, _MISSING)
+            if value is not _MISSING:
+                changes.setdefault("$set", {})[name] = value
+            else:
+                changes.setdefault("$unset", {})[name] = ""
+        return changes
+
+    def _changed_fields(self, previous: dict | None) -> set[str]:
+        # Modified fields whose value differs from the previous document, all of them if it is not known
+        if previous is None:
+            return set(self._dirty)
+        return {field for field in self._dirty if previous.get(field, _MISSING) != getattr(self, field, _MISSING)}
+
+    @classmethod
+    def initialize_cache(cls, cache_instance, codec: BSONCodec | JSONCodec | None = None):
+        """
+        Initializes the Redis cache with proper settings and, optionally,
+        the encoding of the cached documents.
+        """
+        cls.cache = cache_instance
+        if codec is not None:
+            cls.codec = codec
+        cls.cache.config_set("maxmemory", "150mb")
+        cls.cache.config_set("maxmemory-policy", "volatile-lru")
+
+    @classmethod
+    def init_class(cls, db_collection: Collection, required_vars: set[str], admissible_vars: set[str]) -> None:
+        """
+        Initializes the class variables at system initialization.
+        The field sets are frozen and the allowed fields precomputed once.
+        """
+        cls.db = db_collection
+        cls.required_vars = frozenset(required_vars)
+        cls.admissible_vars = frozenset(admissible_vars)
+        cls._allowed_vars = cls.required_vars | cls.admissible_vars | {"_id"}
+
+    @staticmethod
+    def _index_keys(keys: dict | list) -> list[tuple[str, Any]]:
+        # Keys are declared as an ordered mapping or as a list of pairs
+        items = keys.items() if isinstance(keys, dict) else keys
+        return [(field, direction) for field, direction in items]
+
+    @staticmethod
+    def _existing_index(keys: list[tuple[str, Any]], options: dict, information: dict) -> tuple[str | None, list[str]]:
+        """
+        Finds the index matching a declared one in the result of
+        index_information(). Returns its name, None if it does not exist,
+        and the options whose value differs from the declared one.
+        """
+        if any(direction == "text" for _, direction in keys):
+            # Text indexes are stored with _fts and _ftsx keys, they are matched by name
+            name = options.get("name") or "_".join(f"{field}_{direction}" for field, direction in keys)
+            info = information.get(name)
+        else:
+            name, info = next(((name, info) for name, info in information.items()
+                               if [tuple(key) for key in info["key"]] == keys), (None, None))
+        if info is None:
+            return None, []
+        compared = {**_INDEX_OPTION_DEFAULTS,
+                    **{option: value for option, value in options.items() if option not in ("name", "background")}}
+        mismatched = [option for option, value in compared.items()
+                      if info.get(option, _INDEX_OPTION_DEFAULTS.get(option)) != value]
+        return name, mismatched
+
+    @classmethod
+    def ensure_indexes(cls, indexes: list[dict]) -> dict[str, list[str]]:
+        """
+        Reconciles the indexes of the collection with the declared ones.
+        Missing indexes are created and existing ones are left untouched,
+        so it can be called at every startup. Indexes are never dropped.
+        Existing indexes whose options differ from the declared ones are
+        reported as conflicting, they must be dropped to be recreated.
+
+        Parameters
+        ----------
+        indexes : list[dict]
+        declared indexes, each one with its "keys" (e.g. {"name": 1},
+        {"warehouse_coordinates": "2dsphere"} or {"name": "text"}) and
+        any create_index option, such as unique or expireAfterSeconds
+        Returns
+        -------
+        dict[str, list[str]]
+        names of the indexes that were "created", that already "existed",
+        that could not be created or exist with "conflicting" options, that
+        exist but are "undeclared" and that are "unused", i.e. not accessed
+        since the server started
+        """
+        information = cls.db.index_information()
+        report = {"created": [], "existed": [], "conflicting": [], "undeclared": [], "unused": []}
+        declared = set()
+        for index in indexes:
+            keys = cls._index_keys(index["keys"])
+            options = {option: value for option, value in index.items() if option != "keys"}
+            name, mismatched = cls._existing_index(keys, options, information)
+            if name is not None:
+                if mismatched:
+                    logger.warning("Index %s on %s differs from its declaration in: %s",
+                                   name, cls.db.name, ", ".join(mismatched))
+                    report["conflicting"].append(name)
+                else:
+                    report["existed"].append(name)
+            else:
+                try:
+                    name = cls.db.create_index(keys, **options)
+                    report["created"].append(name)
+                except OperationFailure as error:
+                    logger.warning("Could not create index %s on %s: %s", keys, cls.db.name, error)
+                    report["conflicting"].append(options.get("name", str(keys)))
+                    continue
+            declared.add(name)
+        if report["created"]:
+            _collection_info.pop((cls.db.database.name, cls.db.name, "indexed_fields"), None)
+
+        report["undeclared"] = [name for name in information if name != "_id_" and name not in declared]
+
+        try:
+            for stats in cls.db.aggregate([{"$indexStats": {}}]):
+                if stats["name"] != "_id_" and stats["name"] not in report["created"] and stats["accesses"]["ops"] == 0:
+                    report["unused"].append(stats["name"])
+        except OperationFailure:
+            # $indexStats needs the indexStats privilege
+            pass
+        return report
+
+    @classmethod
+    def enable_local_cache(cls, maxsize: int = 10_000, ttl: float = 60.0) -> LocalCache:
+        """
+        Serves find and find_by_id from an in-process cache in front of
+        Redis, see LocalCache. Enabled on Model, it is used by all models.
+        """
+        if cls.cache is None:
+            raise ValueError("Cache has not been initialized. Use 'initialize_cache' first.")
+        cls.disable_local_cache()
+        cls.local_cache = LocalCache(cls.cache, maxsize=maxsize, ttl=ttl)
+        return cls.local_cache
+
+    @classmethod
+    def disable_local_cache(cls) -> None:
+        if cls.local_cache is not None:
+            cls.local_cache.close()
+        cls.local_cache = None
+
+    @classmethod
+    def enable_profiling(cls, threshold_ms: float = 100, explain_sample_rate: float = 0.0,
+                         slow_log_path: str | None = None) -> QueryProfiler:
+        """
+        Starts recording the time and number of documents of the find,
+        find_by_id, aggregate, save and delete calls of this model and its
+        subclasses (all the models if called on Model).
+
+        Parameters
+        ----------
+        threshold_ms : float
+        calls taking at least this many milliseconds are logged as slow
+        explain_sample_rate : float
+        fraction of the read calls that are also explained
+        slow_log_path : str | None
+        file where the slow calls are written, besides the "ODM.slow" logger
+        Returns
+        -------
+        QueryProfiler
+        the profiler collecting the statistics
+        """
+        cls.disable_profiling()
+        cls.profiler = QueryProfiler(threshold_ms, explain_sample_rate, slow_log_path)
+        return cls.profiler
+
+    @classmethod
+    def disable_profiling(cls) -> None:
+        # Only the profiler enabled on this class, the one of a base class is still used by others
+        profiler = cls.__dict__.get("profiler")
+        if profiler is not None:
+            profiler.close()
+        cls.profiler = None
+
+    @classmethod
+    def query_stats(cls) -> dict:
+        """
+        Returns the statistics recorded for this model per operation.
+        """
+        return cls.profiler.stats(cls.__name__) if cls.profiler is not None else {}
+
+    @classmethod
+    def explain(cls, operation: str, *args, **kwargs) -> dict:
+        """
+        Returns the executionStats explain output of a find, find_by_id
+        or aggregate call with the given arguments.
+        """
+        if operation == "find":
+            filter = args[0] if args else kwargs.get("filter", {})
+            return cls.db.find(filter).explain()
+        if operation == "find_by_id":
+            id = args[0] if args else kwargs["id"]
+            return cls.db.find({"_id": _normalize_id(id)}).explain()
+        if operation == "aggregate":
+            pipeline = args[0] if args else kwargs["pipeline"]
+            return cls.db.database.command(
+                "explain", {"aggregate": cls.db.name, "pipeline": pipeline, "cursor": {}},
+                verbosity="executionStats"
+            )
+        raise ValueError(f"Cannot explain operation: {operation}")
+
+    @classmethod
+    @_profiled("find")
+    def find(cls, filter: dict[str, str | dict]) -> list[dict]:
+        if cls.cache is None:
+            raise ValueError("Cache has not been initialized. Use 'initialize_cache' first.")
+
+        cache_key = cls._find_cache_key(filter)
+        local_cache = cls.local_cache
+        if local_cache is not None:
+            generation = local_cache.generation(cls._version_key())
+            results = local_cache.get(cls._version_key(), cache_key)
+            if results is not _MISSING:
+                return results
+
+        # The version is read with the cached result, to fill the cache only if nothing changed meanwhile
+        pipe = cls.cache.pipeline(transaction=False)
+        pipe.get(cache_key)
+        pipe.pttl(cache_key)
+        pipe.get(cls._version_key())
+        cached_result, remaining, version = pipe.execute()
+
+        if cached_result:
+            logger.debug("Returning results from cache for filter: %s", filter)
+            results = cls.codec.decode(cached_result)
+            # Results are kept stale_ttl seconds past their 24 hours, the first caller
+            # to see them stale refreshes them in the background and all return them
+            if 0 <= remaining < cls.stale_ttl * 1000:
+                token = cls._acquire_lock(cache_key)
+                if token is not None:
+                    logger.debug("Refreshing stale results for filter: %s", filter)
+                    _refresh_executor.submit(cls._refresh_find, filter, cache_key, version, token)
+            elif local_cache is not None:
+                local_cache.set(cls._version_key(), cache_key, results, generation)
+            return results
+
+        # Only the caller holding the lock queries MongoDB, the others wait for its
+        # results. If it releases the lock without them (it failed, or a write made
+        # its fill be rejected), one of the waiters takes the lock over
+        token = cls._acquire_lock(cache_key)
+        deadline = time.monotonic() + 2 * cls.lock_timeout
+        while token is None and time.monotonic() < deadline:
+            cached_result = cls._wait_for_fill(cache_key)
+            if cached_result:
+                logger.debug("Returning results filled by another caller for filter: %s", filter)
+                results = cls.codec.decode(cached_result)
+                if local_cache is not None:
+                    local_cache.set(cls._version_key(), cache_key, results, generation)
+                return results
+            token = cls._acquire_lock(cache_key)
+            if token is not None:
+                # The version changed if a write rejected the previous fill
+                version = cls.cache.get(cls._version_key())
+
+        logger.debug("Query not in cache, querying MongoDB for filter: %s", filter)
+        results, filled = cls._load_find(filter, cache_key, version, token)
+        if filled and local_cache is not None:
+            local_cache.set(cls._version_key(), cache_key, results, generation)
+
+        return results
+
+    @classmethod
+    def _load_find(cls, filter: dict[str, str | dict], cache_key: str, version: bytes | None,
+                   token: str | None = None) -> tuple[list[dict], int]:
+        """
+        Queries MongoDB for a find and caches the results, then releases
+        the lock of the query if the token is given. Returns the results
+        and whether they were cached.
+        """
+        try:
+            results = list(cls.db.find(filter))
+
+            # Cache results for 24 hours (86400 seconds), plus the time they may be served
+            # stale, with the document IDs related to this query and the fields the filter
+            # depends on, changing them may add documents to the result
+            index_keys = [f"doc:{doc['_id']}:queries" for doc in results]
+            field_keys = [cls._field_index_key(field) for field in _filter_fields(filter)]
+            filled = cls._fill(version, [cache_key], [cls.codec.encode(results)], 86400 + cls.stale_ttl,
+                               index_keys + field_keys, len(field_keys))
+            logger.debug("Cached results for filter %s: %s", filter, bool(filled))
+        finally:
+            if token is not None:
+                cls._release_lock(cache_key, token)
+        return results, filled
+
+    @classmethod
+    def _refresh_find(cls, filter: dict[str, str | dict], cache_key: str, version: bytes | None, token: str) -> None:
+        # Runs in _refresh_executor, where exceptions would otherwise go unnoticed
+        try:
+            cls._load_find(filter, cache_key, version, token)
+        except Exception:
+            logger.exception("Could not refresh the cached results for filter: %s", filter)
+
+    @classmethod
+    def _acquire_lock(cls, cache_key: str, timeout: float | None = None) -> str | None:
+        """
+        Takes the lock of a cached key for timeout seconds, lock_timeout
+        by default. Returns the token to release it with, or None if
+        another caller holds it.
+        """
+        token = os.urandom(8).hex()
+        if cls.cache.set(f"lock:{cache_key}", token, nx=True, px=int((timeout or cls.lock_timeout) * 1000)):
+            return token
+        return None
+
+    @classmethod
+    def _release_lock(cls, cache_key: str, token: str) -> None:
+        cls._cache_script("release")(keys=[f"lock:{cache_key}"], args=[token])
+
+    @classmethod
+    def _wait_for_fill(cls, cache_key: str, interval: float = 0.05) -> bytes | None:
+        """
+        Polls a cached key while another caller holds its lock. Returns the
+        cached value, or None if the lock was released or expired without it
+        or was still held after lock_timeout seconds.
+        """
+        deadline = time.monotonic() + cls.lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(interval)
+            pipe = cls.cache.pipeline(transaction=False)
+            pipe.get(cache_key)
+            pipe.exists(f"lock:{cache_key}")
+            cached_result, locked = pipe.execute()
+            if cached_result or not locked:
+                return cached_result
+        return None
+
+    @classmethod
+    def _cache_script(cls, name: str):
+        scripts = _cache_scripts.get(cls.cache)
+        if scripts is None:
+            scripts = {
+                "fill": cls.cache.register_script(_FILL_SCRIPT),
+                "invalidate": cls.cache.register_script(_INVALIDATE_SCRIPT),
+                "release": cls.cache.register_script(_RELEASE_SCRIPT),
+            }
+            _cache_scripts[cls.cache] = scripts
+        return scripts[name]
+
+    @classmethod
+    def _fill_args(cls, version: bytes | None, cache_keys: list[str], values: list[bytes], ttl: int,
+                   index_keys: list[str] = (), expiring: int = 0) -> dict:
+        # Keys and arguments of the fill script, see _FILL_SCRIPT
+        return {
+            "keys": [cls._version_key(), *cache_keys, *index_keys],
+            "args": [version or b"0", ttl, len(cache_keys), *values, expiring, 86400],
+        }
+
+    @classmethod
+    def _fill(cls, version: bytes | None, cache_keys: list[str], values: list[bytes], ttl: int,
+              index_keys: list[str] = (), expiring: int = 0) -> int:
+        """
+        Caches the values atomically, only if the version of the collection
+        is still the one read before querying MongoDB. Returns 0 if the
+        collection changed and nothing was cached.
+        """
+        return cls._cache_script("fill")(**cls._fill_args(version, cache_keys, values, ttl, index_keys, expiring))
+
+    @classmethod
+    def _version_key(cls, collection_name: str | None = None) -> str:
+        return f"version:{cls.db.database.name}.{collection_name or cls.db.name}"
+
+    @classmethod
+    @_profiled("aggregate")
+    def aggregate(cls, pipeline: list[dict], cache: bool = False, ttl: int = 86400, optimize: bool = False) -> CommandCursor | list[dict]:
+        """
+        Returns the result of an aggregate query.
+        With cache, the result is stored in Redis under a hash of the pipeline
+        and the versions of every collection it reads. The versions are
+        bumped by the writes of the ODM, so results are recomputed after
+        any of those collections changes.
+        With optimize, the pipeline is rewritten by optimize_pipeline,
+        the problems found by lint_pipeline are logged as warnings and
+        allowDiskUse is set for pipelines with blocking stages over
+        collections larger than disk_use_threshold.
+
+        Parameters
+        ----------
+        pipeline : list[dict]
+        list of stages of the aggregate query
+        cache : bool
+        whether to serve and store the result in the Redis cache
+        ttl : int
+        seconds the cached result is kept
+        optimize : bool
+        whether to rewrite the pipeline before sending it
+        Returns
+        -------
+        pymongo.command_cursor.CommandCursor | list[dict]
+        pymongo cursor with the query result, or the list of result
+        documents if cache is used
+        """
+        options = {}
+        if optimize:
+            pipeline = optimize_pipeline(pipeline)
+            for warning in cls.lint_pipeline(pipeline):
+                logger.warning(warning)
+            blocking_stages = {"$group", "$sort", "$bucket", "$bucketAuto", "$facet", "$setWindowFields"}
+            if (any(stage_name in blocking_stages for stage in pipeline for stage_name in stage)
+                    and cls._collection_info(cls.db.name, "count") >= cls.disk_use_threshold):
+                options["allowDiskUse"] = True
+
+        if not cache:
+            return cls.db.aggregate(pipeline, **options)
+        if cls.cache is None:
+            raise ValueError("Cache has not been initialized. Use 'initialize_cache' first.")
+        if any(stage_name in ("$out", "$merge") for stage in pipeline for stage_name in stage):
+            raise ValueError("Pipelines that write with $out or $merge cannot be cached.")
+
+        collections = cls._aggregate_collections(pipeline)
+        versions = cls.cache.mget([cls._version_key(name) for name in collections])
+        cache_key = cls._aggregate_cache_key(pipeline, collections, versions)
+
+        cached_result = cls.cache.get(cache_key)
+        if cached_result:
+            logger.debug("Returning aggregate results from cache for key: %s", cache_key)
+            return cls.codec.decode(cached_result)
 
-        missing_vars = self.required_vars - set(kwargs.keys())
-        if missing_vars:
-            raise ValueError(f"Missing required variables: {missing_vars}")
+        results = list(cls.db.aggregate(pipeline, **options))
+        cls.cache.setex(cache_key, ttl, cls.codec.encode(results))
+        logger.debug("Cached aggregate results for key: %s", cache_key)
+        return results
 
-        invalid_vars = set(kwargs.keys()) - allowed_vars
-        if invalid_vars:
-            raise ValueError(f"Invalid fields provided: {invalid_vars}")
+    @classmethod
+    def _aggregate_collections(cls, pipeline: list[dict]) -> list[str]:
+        return sorted(_pipeline_collections(pipeline) | {cls.db.name})
 
-        # Assign all the values in kwargs to the instance attributes
-        self.__dict__.update(kwargs)
+    @classmethod
+    def _aggregate_cache_key(cls, pipeline: list[dict], collections: list[str], versions: list) -> str:
+        # Stage and field order are meaningful in a pipeline, so keys are not sorted. BSON keeps
+        # the types, an ObjectId and its hex string or a datetime and its text get different keys
+        encoded = bson.encode({"pipeline": pipeline}, codec_options=BSONCodec.codec_options)
+        pipeline_hash = hashlib.sha256(encoded).hexdigest()
+        version_tag = ",".join(f"{name}@{int(version or 0)}" for name, version in zip(collections, versions))
+        return f"aggregate:{cls.db.database.name}.{cls.db.name}:{pipeline_hash}:{version_tag}"
 
     @classmethod
-    def initialize_cache(cls, cache_instance):
+    def _collection_info(cls, collection_name: str, info: str) -> Any:
         """
-        Initializes the Redis cache with proper settings.
+        Returns the estimated number of documents ("count") or the first
+        fields of the indexes ("indexed_fields") of a collection of the
+        database, read from the server at most every collection_info_ttl
+        seconds so that optimized aggregates do not add round-trips.
         """
-        cls.cache = cache_instance
-        cls.cache.config_set("maxmemory", "150mb")
-        cls.cache.config_set("maxmemory-policy", "volatile-lru")
+        key = (cls.db.database.name, collection_name, info)
+        expires, value = _collection_info.get(key, (0.0, None))
+        if expires > time.monotonic():
+            return value
+        collection = cls.db.database[collection_name]
+        if info == "count":
+            value = collection.estimated_document_count()
+        else:
+            value = {index["key"][0][0] for index in collection.index_information().values()}
+        _collection_info[key] = (time.monotonic() + cls.collection_info_ttl, value)
+        return value
 
     @classmethod
-    def init_class(cls, db_collection: Collection, required_vars: set[str], admissible_vars: set[str]) -> None:
+    def lint_pipeline(cls, pipeline: list[dict]) -> list[str]:
         """
-        Initializes the class variables at system initialization.
+        Returns the problems found in a pipeline: $lookup stages whose
+        foreignField is not the first key of an index of the joined
+        collection, so every lookup scans that collection.
         """
-        cls.db = db_collection
-        cls.required_vars = required_vars
-        cls.admissible_vars = admissible_vars
+        warnings = []
+        for lookup in _pipeline_lookups(pipeline):
+            if "foreignField" not in lookup:
+                continue
+            collection = lookup["from"]
+            if lookup["foreignField"] not in cls._collection_info(collection, "indexed_fields"):
+                warnings.append(
+                    f"$lookup from {collection} on {lookup['foreignField']} has no index, "
+                    f"every lookup scans the collection"
+                )
+        return warnings
 
     @classmethod
-    def find(cls, filter: dict[str, str | dict]) -> list[dict]:
+    @_profiled("find_by_id")
+    def find_by_id(cls, id: str | ObjectId) -> dict | None:
+        """
+        Searches for a document by its id using the cache.
+        If the document is not found, fetches it from the database.
+        The id can be given as an ObjectId or as its string. Ids that
+        do not exist are cached as such for negative_ttl seconds.
+        """
         if cls.cache is None:
             raise ValueError("Cache has not been initialized. Use 'initialize_cache' first.")
 
-        cache_key = f"find:{json.dumps(filter, sort_keys=True)}"
-        cached_result = cls.cache.get(cache_key)
+        id = _normalize_id(id)
+        cache_key = cls._id_cache_key(id)
+        local_cache = cls.local_cache
+        if local_cache is not None:
+            generation = local_cache.generation(cls._version_key())
+            document = local_cache.get(cls._version_key(), cache_key)
+            if document is not _MISSING:
+                return document
 
-        if cached_result:
-            cls.cache.expire(cache_key, 86400)
-            print(f"Returning results from cache for filter: {filter}")
-            return json.loads(cached_result)
+        # Check in cache
+        cached_data, version = cls.cache.mget([cache_key, cls._version_key()])
+        if cached_data is not None:
+            logger.debug("Returning cached data for ID %s", id)
+            document = cls.codec.decode(cached_data)
+        else:
+            # Fetch from database
+            logger.debug("No cached data found for ID %s, querying MongoDB", id)
+            document = cls.db.find_one({'_id': id})
+            # Save to cache, a missing document as None for a short time,
+            # inserting it invalidates its id key
+            ttl = 86400 if document else cls.negative_ttl
+            if not cls._fill(version, [cache_key], [cls.codec.encode(document)], ttl):
+                return document
+        if local_cache is not None:
+            local_cache.set(cls._version_key(), cache_key, document, generation)
+        return document
 
-        print(f"We don't have such query in cache\nQuerying MongoDB for filter: {filter}")
-        cursor = cls.db.find(filter)
-        results = list(cursor)
+    @classmethod
+    @_profiled("find_by_ids")
+    def find_by_ids(cls, ids: Iterable[str | ObjectId]) -> list[dict | None]:
+        """
+        Searches for several documents by their ids using the cache, with
+        one MGET for all the ids and one query for the ones not cached,
+        which are then cached atomically, the missing ones for negative_ttl
+        seconds.
 
-        # Cache results for 24 hours (86400 seconds)
-        cls.cache.setex(cache_key, 86400, json.dumps(results, default=str))
+        Parameters
+        ----------
+        ids : Iterable[str | ObjectId]
+        ids of the documents, as ObjectIds or as their strings
+        Returns
+        -------
+        list[dict | None]
+        documents in the order of the ids, None for the ids not found
+        """
+        if cls.cache is None:
+            raise ValueError("Cache has not been initialized. Use 'initialize_cache' first.")
 
-        # Save document IDs related to this query
-        document_ids = [str(doc["_id"]) for doc in results]
-        for doc_id in document_ids:
-            cls.cache.sadd(f"doc:{doc_id}:queries", cache_key)  # Associate document ID with query key
-        print(f"Cached results for filter: {filter} with associated document IDs: {document_ids}")
+        ids = [_normalize_id(id) for id in ids]
+        if not ids:
+            return []
+        cache_keys = [cls._id_cache_key(id) for id in ids]
+
+        *cached_values, version = cls.cache.mget(cache_keys + [cls._version_key()])
+        documents = {}
+        misses = {}
+        for id, cache_key, cached_data in zip(ids, cache_keys, cached_values):
+            if cached_data is not None:
+                documents[cache_key] = cls.codec.decode(cached_data)
+            else:
+                misses[cache_key] = id
+
+        if misses:
+            logger.debug("%d of %d IDs not cached, querying MongoDB", len(misses), len(ids))
+            found = {}
+            for document in cls.db.find({'_id': {'$in': list(misses.values())}}):
+                found[cls._id_cache_key(document['_id'])] = document
+            if found:
+                cls._fill(version, list(found), [cls.codec.encode(document) for document in found.values()], 86400)
+            # The ids not found are cached as None for a short time, as in find_by_id
+            absent = [cache_key for cache_key in misses if cache_key not in found]
+            if absent:
+                cls._fill(version, absent, [cls.codec.encode(None)] * len(absent), cls.negative_ttl)
+            documents.update(found)
+        return [documents.get(cache_key) for cache_key in cache_keys]
 
-        return results
+    @classmethod
+    def _find_cache_key(cls, filter: dict) -> str:
+        # Scoped like the documents, so models and databases sharing a cache never share a key
+        return f"find:{cls.db.database.name}.{cls.db.name}:{json.dumps(filter, sort_keys=True)}"
+
+    @classmethod
+    def _id_cache_key(cls, id: Any) -> str:
+        return f"id:{cls.db.database.name}.{cls.db.name}:{id}"
 
     @classmethod
-    def find_by_id(cls, id: str) -> dict | None:
+    def scan(cls, filter: dict[str, str | dict] | None = None, projection: dict | list | None = None,
+             sort: list | None = None, limit: int = 0, batch_size: int = 0, raw: bool = False) -> "ModelCursor":
         """
-        Searches for a document by its id using the cache.
-        If the document is not found, fetches it from the database.
+        Performs an uncached read query and returns a ModelCursor over it,
+        meant for iterating over large results.
+
+        Parameters
+        ----------
+        filter : dict[str, str | dict] | None
+        dictionary with the search criteria of the query
+        projection : dict | list | None
+        fields to return, the models are built from the partial documents
+        sort : list | None
+        list of (key, direction) pairs to sort the results by
+        limit : int
+        maximum number of documents, 0 for no limit
+        batch_size : int
+        number of documents per round-trip, 0 for the server default
+        raw : bool
+        yield plain dicts, skipping model creation and validation
+        Returns
+        -------
+        ModelCursor
+        model cursor
         """
-        if cls.cache is None:
-            raise ValueError("Cache has not been initialized. Use 'initialize_cache' first.")
+        cursor = cls.db.find(filter or {}, projection, sort=sort, limit=limit, batch_size=batch_size)
+        return ModelCursor(cls, cursor, raw=raw, partial=projection is not None)
 
-        # Check in cache
-        cached_data = cls.cache.get(id)
-        if cached_data:
-            print(f"Returning cached data for ID {id}.")
-            return json.loads(cached_data)
-
-        # Fetch from database
-        print(f"No cached data found for ID {id}. Querying MongoDB.")
-        document = cls.db.find_one({'_id': id})
-        if document:
-            cls.cache.set(id, json.dumps(document, default=str), ex=86400)  # Save to cache
-        return document
+    @classmethod
+    def _partition_filters(cls, filter: dict, field: str, partitions: int) -> list[dict]:
+        """
+        Splits the documents matching filter into ranges of field with
+        roughly the same number of documents. The bounds are the quantiles
+        of a random sample of the collection, not of all the matching
+        documents, so that they cost much less than the scan. The first
+        range also holds the documents where field is missing, null or of
+        another type than the bounds.
+        """
+        sample = [document.get("value") for document in cls.db.aggregate([
+            {"$sample": {"size": cls.partition_sample * partitions}},
+            {"$project": {"_id": 0, "value": f"${field}"}},
+        ])]
+        try:
+            values = sorted(value for value in sample if value is not None)
+        except TypeError:
+            # Values of several types, the collection is scanned as a single range
+            values = []
+        # The first and last ranges are open, values outside the sample still fall in them
+        boundaries = sorted({values[len(values) * position // partitions] for position in range(1, partitions)}) if values else []
+        if not boundaries:
+            return [filter]
+        # Comparisons only match values of the same type, so the first range is
+        # everything that is not in the others
+        ranges = [{"$not": {"$gte": boundaries[0]}}]
+        ranges += [{"$gte": lower, "$lt": upper} for lower, upper in zip(boundaries, boundaries[1:])]
+        ranges.append({"$gte": boundaries[-1]})
+        return [{"$and": [filter, {field: bounds}]} if filter else {field: bounds} for bounds in ranges]
 
+    @classmethod
+    def parallel_scan(cls, filter: dict[str, str | dict] | None = None, workers: int = 4, field: str = "_id",
+                      projection: dict | list | None = None, raw: bool = False, batch_size: int = 1000,
+                      callback=None) -> Generator | None:
+        """
+        Scans the documents matching filter concurrently. The documents are
+        split into one range of field per worker and every range is read
+        with its own cursor on a thread pool. field should be indexed and
+        present in every document.
+
+        Parameters
+        ----------
+        filter : dict[str, str | dict] | None
+        dictionary with the search criteria of the query
+        workers : int
+        number of ranges scanned concurrently
+        field : str
+        field used to split the collection into ranges
+        projection : dict | list | None
+        fields to return, the models are built from the partial documents
+        raw : bool
+        yield plain dicts, skipping model creation and validation
+        batch_size : int
+        number of documents read per round-trip by every cursor
+        callback : Callable[[int, list], None] | None
+        if given, called from the worker threads with the partition number
+        and every batch read, instead of returning an iterator
+        Returns
+        -------
+        Generator | None
+        iterator over the models (or dicts) of all the ranges in no
+        particular order, None if callback is given
+        """
+        filter = filter or {}
+        partitions = cls._partition_filters(filter, field, workers)
+
+        def scan_partition(partition: int, partition_filter: dict, handle) -> None:
+            cursor = cls.scan(partition_filter, projection, batch_size=batch_size, raw=raw)
+            try:
+                for batch in cursor.iter_batches(batch_size):
+                    handle(partition, batch)
+            finally:
+                cursor.cursor.close()
+
+        if callback is not None:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(scan_partition, partition, partition_filter, callback)
+                           for partition, partition_filter in enumerate(partitions)]
+                for future in futures:
+                    future.result()
+            return None
+
+        return cls._merge_partitions(partitions, workers, scan_partition)
+
+    @staticmethod
+    def _merge_partitions(partitions: list[dict], workers: int, scan_partition) -> Generator:
+        # Bounded so that fast partitions do not buffer the whole collection
+        batches = queue.Queue(maxsize=2 * workers)
+        stopped = threading.Event()
+        done = object()
+
+        def put(item) -> None:
+            while not stopped.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+            # Interrupts the scan of the partition, its cursor is closed
+            raise _ScanStopped()
+
+        def produce(partition: int, partition_filter: dict) -> None:
+            try:
+                scan_partition(partition, partition_filter, lambda _, batch: put(batch))
+                put(done)
+            except _ScanStopped:
+                pass
+            except Exception as error:
+                with contextlib.suppress(_ScanStopped):
+                    put(error)
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        for partition, partition_filter in enumerate(partitions):
+            executor.submit(produce, partition, partition_filter)
+        try:
+            pending = len(partitions)
+            while pending:
+                item = batches.get()
+                if item is done:
+                    pending -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield from item
+        finally:
+            # Stops the producers if the consumer stops early
+            stopped.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    @classmethod
+    def from_document(cls, document: dict) -> Self:
+        """
+        Builds a model from a trusted document read from the database,
+        without checking the fields. Used for projected documents.
+        """
+        model = cls.__new__(cls)
+        model.__dict__.update(document)
+        model.__dict__["_dirty"] = set()
+        return model
+
+    @_profiled("save")
     def save(self) -> None:
         """
         Save the model in the database.
         If the model does not exist in the database, a new document is created
-        with the model values. Otherwise, the existing document is updated with the new
-        model values. Invalidates all related cache entries.
+        with the model values. Otherwise, only the modified fields are updated
+        and nothing is sent if no field changed. Invalidates the cache entries
+        related to the document and to the modified fields.
+        Inside a session, the write is buffered until the session ends.
         """
+        uow = current_session()
+        if uow is not None:
+            uow.register_save(self)
+            return
+
         if not hasattr(self, '_id'):
-            result = self.db.insert_one(self.__dict__)
+            document = self.to_document()
+            result = self.db.insert_one(document)
             self._id = str(result.inserted_id)
+            changed_fields = set(document) - {"_id"}
         else:
-            update_data = {key: value for key, value in self.__dict__.items() if key != '_id'}
-            self.db.update_one({'_id': self._id}, {'$set': update_data})
+            changes = self._changes()
+            if not changes:
+                logger.debug("No changes to save for model %s", self.__class__.__name__)
+                return
+            # The previous values tell which fields really changed, a model built
+            # with Model(**document) has all its fields marked as modified
+            previous = self.db.find_one_and_update({'_id': _normalize_id(self._id)}, changes,
+                                                   projection={field: 1 for field in self._dirty})
+            changed_fields = self._changed_fields(previous)
+        self._dirty.clear()
+
+        logger.debug("Invalidating cache for model %s due to save", self.__class__.__name__)
+        self.invalidate_cache(changed_fields)
 
-        print(f"Invalidating cache for model {self.__class__.__name__} due to save...")
-        self.invalidate_cache()
+    @classmethod
+    def save_many(cls, models: Iterable[Self], ordered: bool = False, batch_size: int = 1000) -> None:
+        """
+        Saves several models of this class using batched bulk_write calls.
+        Models without an _id are inserted and get their new _id assigned,
+        the rest only update their modified fields and are skipped if nothing
+        changed. Cache entries of every saved document are invalidated once
+        per batch. If a write of a batch fails, the models written still get
+        their _id and are invalidated before the BulkWriteError is raised.
 
+        Parameters
+        ----------
+        models : Iterable[Model]
+        models to save, all of them instances of this class
+        ordered : bool
+        whether MongoDB must stop at the first failed write of a batch
+        batch_size : int
+        maximum number of write operations sent in one bulk_write
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be a positive integer.")
+
+        uow = current_session()
+        if uow is not None:
+            for model in models:
+                if not isinstance(model, cls):
+                    raise TypeError(f"Expected {cls.__name__} instance, got {type(model).__name__}")
+                uow.register_save(model)
+            return
+
+        models = iter(models)
+        while batch := list(islice(models, batch_size)):
+            operations = []
+            # (model, inserted document or None), in the order of the operations
+            saved = []
+            changed_fields = set()
+            for model in batch:
+                if not isinstance(model, cls):
+                    raise TypeError(f"Expected {cls.__name__} instance, got {type(model).__name__}")
+                if not hasattr(model, '_id'):
+                    document = model.to_document()
+                    operations.append(InsertOne(document))
+                    saved.append((model, document))
+                    changed_fields |= set(document)
+                else:
+                    changes = model._changes()
+                    if not changes:
+                        continue
+                    operations.append(UpdateOne({'_id': _normalize_id(model._id)}, changes))
+                    saved.append((model, None))
+                    changed_fields |= model._dirty
+
+            if not operations:
+                continue
+            # Positions of the operations that were not written, with an unordered
+            # bulk_write the others are written even if it raises
+            failed = set()
+            try:
+                cls.db.bulk_write(operations, ordered=ordered)
+            except BulkWriteError as error:
+                failed = {write_error["index"] for write_error in error.details["writeErrors"]}
+                if ordered and failed:
+                    failed = set(range(min(failed), len(operations)))
+                raise
+            except Exception:
+                failed = set(range(len(operations)))
+                raise
+            finally:
+                # pymongo sets the generated _id on the documents passed to InsertOne
+                for position, (model, document) in enumerate(saved):
+                    if position in failed:
+                        continue
+                    if document is not None:
+                        model._id = str(document['_id'])
+                    model._dirty.clear()
+
+                # Updates of failed writes may still have been applied, their cache is invalidated too
+                ids = [model._id for model, _ in saved if hasattr(model, '_id')]
+                logger.debug("Invalidating cache for %d %s models due to bulk save", len(ids), cls.__name__)
+                cls.invalidate_cache_for_ids(ids, changed_fields - {"_id"})
+
+    @_profiled("delete")
     def delete(self) -> None:
         """
         Deletes the model from the database and invalidates cache.
+        Inside a session, the delete is buffered until the session ends.
         """
         if not hasattr(self, '_id'):
             raise ValueError("Cannot delete a model without an ID.")
 
-        self.db.delete_one({'_id': str(self._id)})
-        print(f"Deleted from MongoDB: {self._id}")
-        if self.cache:
-            self.cache.delete(str(self._id))
-            print(f"Removed from cache: {self._id}")
+        uow = current_session()
+        if uow is not None:
+            uow.register_delete(self)
+            return
+
+        self.db.delete_one({'_id': _normalize_id(self._id)})
+        logger.debug("Deleted from MongoDB: %s", self._id)
 
-        print(f"Invalidating cache for model {self.__class__.__name__} due to delete...")
+        logger.debug("Invalidating cache for model %s due to delete", self.__class__.__name__)
         self.invalidate_cache()
 
-    def invalidate_cache(self):
+    @classmethod
+    def _matching_ids(cls, filter: dict, batch_size: int) -> Generator[list, None, None]:
+        # Ids of the documents matching the filter, read with a covered projection
+        cursor = cls.db.find(filter, {"_id": 1}, batch_size=batch_size)
+        documents = iter(cursor)
+        while batch := list(islice(documents, batch_size)):
+            yield [document["_id"] for document in batch]
+
+    @staticmethod
+    def _update_fields(update: dict | list) -> set[str] | None:
+        # Top-level fields written by an update, None for aggregation pipeline updates
+        if isinstance(update, list):
+            return None
+        fields = set()
+        for operator, spec in update.items():
+            fields |= {field.split(".")[0] for field in spec}
+            if operator == "$rename":
+                fields |= {field.split(".")[0] for field in spec.values()}
+        return fields
+
+    @classmethod
+    @_profiled("update_many")
+    def update_many(cls, filter: dict, update: dict | list, batch_size: int = 10_000) -> int:
+        """
+        Updates the documents matching the filter and invalidates their
+        cached queries and the cached queries filtering on the updated
+        fields. The ids are read first with a projected query and each
+        batch of ids is updated with one update_many and invalidated with
+        one call of the invalidation script. Documents that start matching
+        the filter after the ids are read are not updated. The ids are all
+        read before the first update, so every document is updated once.
+
+        Parameters
+        ----------
+        filter : dict
+        dictionary with the search criteria of the documents to update
+        update : dict | list
+        update operators, or an aggregation pipeline update
+        batch_size : int
+        number of ids updated per round-trip
+        Returns
+        -------
+        int
+        number of documents modified
+        """
+        fields = cls._update_fields(update)
+        if fields is None:
+            fields = set(cls._allowed_vars - {"_id"})
+        modified = 0
+        # All the ids are read before the first write: read lazily, a document that an
+        # update moves forward in the index being scanned would be returned again
+        for ids in list(cls._matching_ids(filter, batch_size)):
+            result = cls.db.update_many({"$and": [filter, {"_id": {"$in": ids}}]}, update)
+            modified += result.modified_count
+            cls.invalidate_cache_for_ids([str(id) for id in ids], fields)
+        logger.debug("Updated %d documents of %s", modified, cls.__name__)
+        return modified
+
+    @classmethod
+    @_profiled("delete_many")
+    def delete_many(cls, filter: dict, batch_size: int = 10_000) -> int:
+        """
+        Deletes the documents matching the filter and invalidates their
+        cached queries, in batches of ids as update_many.
+
+        Parameters
+        ----------
+        filter : dict
+        dictionary with the search criteria of the documents to delete
+        batch_size : int
+        number of ids deleted per round-trip
+        Returns
+        -------
+        int
+        number of documents deleted
+        """
+        deleted = 0
+        for ids in cls._matching_ids(filter, batch_size):
+            result = cls.db.delete_many({"$and": [filter, {"_id": {"$in": ids}}]})
+            deleted += result.deleted_count
+            cls.invalidate_cache_for_ids([str(id) for id in ids])
+        logger.debug("Deleted %d documents of %s", deleted, cls.__name__)
+        return deleted
+
+    def invalidate_cache(self, fields: set[str] | None = None):
+        """
+        Invalidates the cached queries that contain this document and,
+        if fields are given, the cached queries that filter on them,
+        since the document may now match them.
+        """
         if self.cache is None:
             raise ValueError("Cache has not been initialized. Use 'initialize_cache' first.")
 
         if not hasattr(self, "_id"):
             raise ValueError("Cannot invalidate cache for a model without an ID.")
 
-        # Get all queries associated with this document ID
-        cache_keys = self.cache.smembers(f"doc:{self._id}:queries")
-        for cache_key in cache_keys:
-            self.cache.delete(cache_key)
-            print(f"Invalidated cache key: {cache_key.decode('utf-8')}")
+        self.invalidate_cache_for_ids([self._id], fields)
+
+    @classmethod
+    def register_view(cls, view: "MaterializedView") -> None:
+        """
+        Registers a materialized view in Redis so that the ids of the
+        documents saved or deleted, by any process, are recorded for its
+        next refresh.
+        """
+        if cls.cache is None:
+            raise ValueError("Cache has not been initialized. Use 'initialize_cache' first.")
+        cls.cache.sadd(cls._views_key(), view.changes_key)
+
+    @classmethod
+    def _views_key(cls) -> str:
+        return f"views:{cls.db.database.name}.{cls.db.name}"
+
+    @classmethod
+    def _field_index_key(cls, field: str) -> str:
+        return f"fields:{cls.db.name}:{field}:queries"
+
+    @classmethod
+    def _invalidation_index_keys(cls, doc_ids: list[str], fields: set[str] | None) -> list[str]:
+        # Sets with the cached queries to remove: those of the documents and those filtering on the fields
+        index_keys = [f"doc:{doc_id}:queries" for doc_id in doc_ids]
+        if fields:
+            index_keys += [cls._field_index_key(field) for field in fields | {"*"}]
+        return index_keys
+
+    @classmethod
+    def invalidate_cache_for_ids(cls, doc_ids: list[str], fields: set[str] | None = None) -> None:
+        """
+        Invalidates the cached queries of several documents at once.
+        The query sets are read and all the keys removed by one script,
+        atomically, which also increments the version of the collection,
+        so that fills of queries that read the old documents are dropped.
+
+        Parameters
+        ----------
+        doc_ids : list[str]
+        ids of the documents whose cached queries must be invalidated
+        fields : set[str] | None
+        modified fields, cached queries filtering on them are invalidated too
+        """
+        if cls.cache is None:
+            raise ValueError("Cache has not been initialized. Use 'initialize_cache' first.")
+        if not doc_ids:
+            return
+
+        removed = cls._cache_script("invalidate")(**cls._invalidate_args(doc_ids, fields))
+        # The published message also reaches this process, but later
+        if cls.local_cache is not None:
+            cls.local_cache.invalidate(cls._version_key())
+        logger.debug("Invalidated %d cache keys for %d documents", removed, len(doc_ids))
+
+    @classmethod
+    def _invalidate_args(cls, doc_ids: list[str], fields: set[str] | None) -> dict:
+        # Keys and arguments of the invalidation script, see _INVALIDATE_SCRIPT.
+        # The new version of the collection also makes stale the cached aggregates that read it.
+        index_keys = cls._invalidation_index_keys(doc_ids, fields)
+        id_keys = [cls._id_cache_key(_normalize_id(doc_id)) for doc_id in doc_ids]
+        return {
+            "keys": [*index_keys, cls._version_key(), *id_keys, cls._views_key()],
+            "args": [len(index_keys), len(id_keys), INVALIDATION_CHANNEL, *map(str, doc_ids)],
+        }
+
+
+class _ScanStopped(Exception):
+    """
+    Raised in the threads of parallel_scan when its iterator is closed.
+    """
+
+
+class UnitOfWork:
+    """
+    Buffer of the saves and deletes of models, written when the session
+    ends with one bulk_write per collection, optionally in a transaction,
+    and followed by one cache invalidation per collection.
+    Repeated writes of the same document are coalesced: only its last
+    state is written, and a document inserted and deleted in the same
+    session is never written. New models get their id when they are
+    saved, so it can be referenced before the session ends.
+    Created by session().
+    """
+
+    def __init__(self, transaction: bool = False):
+        self.transaction = transaction
+        # (model class, id) -> [operation, models], in the order of the first write
+        self._pending: dict[tuple[type, str], list] = {}
+
+    def register_save(self, model: "Model") -> None:
+        if not hasattr(model, "_id"):
+            model._id = str(ObjectId())
+            self._pending[(type(model), model._id)] = ["insert", [model]]
+            return
+
+        key = (type(model), str(model._id))
+        entry = self._pending.get(key)
+        if entry is None:
+            self._pending[key] = ["update", [model]]
+        elif entry[0] == "delete":
+            raise ValueError(f"Cannot save document {model._id}, it was deleted in this session.")
+        elif entry[0] == "insert":
+            entry[1] = [model]
+        elif all(other is not model for other in entry[1]):
+            # Another object of the same document, the changes of both are merged
+            entry[1].append(model)
+
+    def register_delete(self, model: "Model") -> None:
+        key = (type(model), str(model._id))
+        entry = self._pending.get(key)
+        if entry is not None and entry[0] == "insert":
+            # Never written, the model loses its id as in discard()
+            del self._pending[key]
+            object.__delattr__(entry[1][0], "_id")
+        else:
+            self._pending[key] = ["delete", [model]]
+
+    @staticmethod
+    def _merge_changes(models: list["Model"]) -> dict:
+        update = {}
+        for model in models:
+            for operator, fields in model._changes().items():
+                other = update.get("$unset" if operator == "$set" else "$set", {})
+                for field, value in fields.items():
+                    other.pop(field, None)
+                    update.setdefault(operator, {})[field] = value
+        return {operator: fields for operator, fields in update.items() if fields}
+
+    def flush(self) -> None:
+        """
+        Writes the buffered operations and invalidates the cache.
+        """
+        operations: dict[type, list] = {}
+        written: dict[type, tuple[list[str], set[str]]] = {}
+        # model class -> (position of the operation, new model)
+        inserts: dict[type, list[tuple[int, Model]]] = {}
+        saved = []
+        for (model_class, id), (operation, models) in self._pending.items():
+            if operation == "insert":
+                document = models[0].to_document()
+                document["_id"] = ObjectId(id)
+                inserts.setdefault(model_class, []).append((len(operations.get(model_class, ())), models[0]))
+                operations.setdefault(model_class, []).append(InsertOne(document))
+                fields = set(document) - {"_id"}
+            elif operation == "update":
+                update = self._merge_changes(models)
+                if not update:
+                    continue
+                operations.setdefault(model_class, []).append(UpdateOne({'_id': _normalize_id(id)}, update))
+                fields = set().union(*(model._dirty for model in models))
+            else:
+                operations.setdefault(model_class, []).append(DeleteOne({'_id': _normalize_id(id)}))
+                fields = set()
+            ids, changed_fields = written.setdefault(model_class, ([], set()))
+            ids.append(id)
+            changed_fields |= fields
+            saved.extend(models)
+        self._pending = {}
+        if not operations:
+            return
+
+        # Collections fully written, and positions of the failed writes of the one that failed
+        written_classes = set()
+        failed: dict[type, set[int]] = {}
+        try:
+            if self.transaction:
+                client = next(iter(operations)).db.database.client
+                with client.start_session() as mongo_session:
+                    mongo_session.with_transaction(lambda transaction_session: [
+                        model_class.db.bulk_write(model_operations, session=transaction_session)
+                        for model_class, model_operations in operations.items()
+                    ])
+                written_classes.update(operations)
+                for model_class in operations:
+                    self._invalidate(model_class, *written[model_class])
+            else:
+                # Each collection is invalidated after its own write, even if it fails
+                # part way, so that a later failing collection leaves no stale cache
+                for model_class, model_operations in operations.items():
+                    try:
+                        model_class.db.bulk_write(model_operations, ordered=False)
+                    except BulkWriteError as error:
+                        failed[model_class] = {write_error["index"] for write_error in error.details["writeErrors"]}
+                        raise
+                    finally:
+                        self._invalidate(model_class, *written[model_class])
+                    written_classes.add(model_class)
+        except Exception:
+            # New models that were not inserted lose their id, as in discard(),
+            # so that saving them again inserts them
+            for model_class, model_inserts in inserts.items():
+                if model_class in written_classes:
+                    continue
+                for position, model in model_inserts:
+                    if model_class not in failed or position in failed[model_class]:
+                        object.__delattr__(model, "_id")
+            raise
+
+        for model in saved:
+            model._dirty.clear()
+
+    @staticmethod
+    def _invalidate(model_class: type, ids: list[str], changed_fields: set[str]) -> None:
+        logger.debug("Invalidating cache for %d %s documents written by a session", len(ids), model_class.__name__)
+        model_class.invalidate_cache_for_ids(ids, changed_fields)
+
+    def discard(self) -> None:
+        """
+        Drops the buffered operations, new models lose the id they got.
+        """
+        for operation, models in self._pending.values():
+            if operation == "insert":
+                object.__delattr__(models[0], "_id")
+        self._pending = {}
+
+
+_session_state = threading.local()
+
+
+def current_session() -> UnitOfWork | None:
+    """
+    Returns the unit of work of the session open in this thread, if any.
+    """
+    return getattr(_session_state, "uow", None)
+
+
+@contextlib.contextmanager
+def session(transaction: bool = False) -> Generator[UnitOfWork, None, None]:
+    """
+    Opens a session in this thread: the saves and deletes of models are
+    buffered and written when the block ends, see UnitOfWork. If the
+    block raises, nothing is written. A session opened inside another
+    one joins it.
+
+    Parameters
+    ----------
+    transaction : bool
+    write all the collections in one MongoDB transaction, which needs
+    a replica set
+    """
+    uow = current_session()
+    if uow is not None:
+        yield uow
+        return
+
+    uow = UnitOfWork(transaction)
+    _session_state.uow = uow
+    try:
+        yield uow
+    except BaseException:
+        uow.discard()
+        raise
+    finally:
+        _session_state.uow = None
+    uow.flush()
+
+
+class MaterializedView:
+    """
+    Collection with the result of a pipeline over the documents of a model,
+    refreshed incrementally with $merge. Refreshes of the same view, from
+    any process, run one at a time.
+    The pipeline must produce at most one document per source document,
+    keeping its _id. The ODM records the ids of the documents written since
+    the last refresh, and refresh() only recomputes those documents. Rows are
+    replaced one by one, and full refreshes use $out, which replaces the
+    collection atomically, so readers never see a half-built view.
+    The view is registered in Redis, so the writes of processes that never
+    created it are recorded too. Only writes to the source collection are
+    tracked: rows that join other collections with $lookup are not
+    recomputed when those collections change, use refresh(full=True).
+
+    Attributes
+    ----------
+    name : str
+    name of the view collection
+    model : Model
+    model whose collection is the source of the view
+    pipeline : list[dict]
+    stages computing the view rows from the source documents
+    """
+
+    # Seconds a refresh holds the lock of the view, and waits for it
+    lock_timeout: float = 600.0
+
+    def __init__(self, name: str, model: type, pipeline: list[dict]):
+        self.name = name
+        self.model = model
+        self.pipeline = pipeline
+        self.collection = model.db.database[name]
+        self.changes_key = f"view:{model.db.database.name}.{name}:changes"
+        if model.cache is not None:
+            model.register_view(self)
+
+    @staticmethod
+    def _source_ids(ids: set[bytes]) -> list:
+        # The ODM keeps ids as strings, the documents may use ObjectIds
+        source_ids = []
+        for id in ids:
+            id = id.decode("utf-8")
+            source_ids.append(id)
+            if ObjectId.is_valid(id):
+                source_ids.append(ObjectId(id))
+        return source_ids
+
+    def refresh(self, full: bool = False) -> int:
+        """
+        Brings the view up to date. Only the documents written since the
+        last refresh are recomputed, unless full is given or the view does
+        not exist yet.
+
+        Returns
+        -------
+        int
+        number of source documents recomputed, -1 for a full refresh
+        """
+        if self.model.cache is None:
+            raise ValueError("Cache has not been initialized. Use 'initialize_cache' first.")
+        # Registered again in case the cache was initialized after the view was created or was flushed
+        self.model.register_view(self)
+
+        # Overlapping refreshes would take the same processing set, and each one
+        # would delete the rows the other one merged
+        deadline = time.monotonic() + self.lock_timeout
+        while (token := self.model._acquire_lock(self.changes_key, self.lock_timeout)) is None:
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Another refresh of view {self.name} is still running.")
+            time.sleep(0.1)
+        try:
+            return self._refresh(full)
+        finally:
+            self.model._release_lock(self.changes_key, token)
+
+    def _refresh(self, full: bool) -> int:
+        cache = self.model.cache
+        processing_key = f"{self.changes_key}:processing"
+
+        if full or self.name not in self.model.db.database.list_collection_names():
+            cache.delete(self.changes_key, processing_key)
+            self.model.db.aggregate(self.pipeline + [{"$out": self.name}])
+            return -1
+
+        # Take the pending ids atomically, writes from now on go to a new set.
+        # Ids left in the processing set by a failed refresh are retried.
+        pipe = cache.pipeline(transaction=True)
+        pipe.sunionstore(processing_key, [processing_key, self.changes_key])
+        pipe.delete(self.changes_key)
+        pipe.smembers(processing_key)
+        changed_ids = pipe.execute()[-1]
+        if not changed_ids:
+            return 0
+
+        source_ids = self._source_ids(changed_ids)
+        refresh_id = ObjectId()
+        self.model.db.aggregate(
+            [{"$match": {"_id": {"$in": source_ids}}}]
+            + self.pipeline
+            + [{"$set": {"_refresh": refresh_id}},
+               {"$merge": {"into": self.name, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}}]
+        )
+        # Rows of deleted documents, or of documents that no longer produce a row
+        self.collection.delete_many({"_id": {"$in": source_ids}, "_refresh": {"$ne": refresh_id}})
+        cache.delete(processing_key)
+        return len(changed_ids)
+
+
+class ReferenceLoader:
+    """
+    Resolves the references by name of groups of models with one $in
+    query per referenced model and field. The loaded models are kept in
+    a memo shared by all the groups, so a loader should live as long as
+    one request.
+    """
+
+    def __init__(self):
+        # (model class, key field) -> key value -> model, None if not found
+        self._memo: dict[tuple[type, str], dict[Any, Model | None]] = {}
+
+    def load_many(self, model_class: type, key: str, values: Iterable) -> dict[Any, "Model | None"]:
+        """
+        Returns the models of model_class whose key field has one of the
+        given values, querying only the values that are not in the memo.
+        """
+        memo = self._memo.setdefault((model_class, key), {})
+        values = set(values)
+        missing = [value for value in values if value not in memo]
+        if missing:
+            loaded = []
+            for document in model_class.db.find({key: {"$in": missing}}):
+                if document[key] not in memo:
+                    memo[document[key]] = model_class.from_document(document)
+                    loaded.append(memo[document[key]])
+            # Their own references are also loaded together
+            self.attach(loaded)
+            for value in missing:
+                memo.setdefault(value, None)
+        return {value: memo[value] for value in values}
+
+    def attach(self, models: list["Model"]) -> "_ReferencePage":
+        """
+        Attaches the loader to a group of models. Nothing is queried until
+        a reference of one of them is read with Model.ref.
+        """
+        page = _ReferencePage(self, models)
+        for model in models:
+            object.__setattr__(model, "_refs", page)
+        return page
+
+
+class _ReferencePage:
+    """
+    Group of models whose references are loaded together, one field at
+    a time, the first time a reference of that field is read.
+    """
+
+    def __init__(self, loader: ReferenceLoader, models: list["Model"]):
+        self.loader = loader
+        self.models = models
+        self.loaded: dict[str, dict] = {}
+
+    def resolve(self, model: "Model", field: str):
+        model_class, key = model.references[field]
+        if field not in self.loaded:
+            values = set()
+            for page_model in self.models:
+                value = getattr(page_model, field, None)
+                if isinstance(value, list):
+                    values.update(value)
+                elif value is not None:
+                    values.add(value)
+            self.loaded[field] = self.loader.load_many(model_class, key, values)
+        references = self.loaded[field]
+        value = getattr(model, field, None)
+        items = value if isinstance(value, list) else [] if value is None else [value]
+        # Values assigned after the page was loaded, the memo of the loader avoids querying them again
+        missing = [item for item in items if item not in references]
+        if missing:
+            references.update(self.loader.load_many(model_class, key, missing))
+        if isinstance(value, list):
+            return [references.get(item) for item in value]
+        return None if value is None else references.get(value)
+
+
+class SlottedModel(Model):
+    """
+    Model whose fields are stored in __slots__ instead of a per-instance
+    __dict__, which reduces the memory used by every instance.
+    Classes are generated by build_model_class with one slot per field.
+    """
+    __slots__ = ("_dirty", "_refs")
+    _fields: tuple[str, ...] = ()
+    # Setters of the slot descriptors, calling them skips __setattr__
+    _slot_setters: dict = {}
+
+    def __init__(self, **kwargs):
+        self._check_fields(kwargs)
+        setters = self._slot_setters
+        for name, value in kwargs.items():
+            setters[name](self, value)
+        object.__setattr__(self, "_dirty", set(kwargs) - {"_id"} if "_id" in kwargs else set())
+
+    @classmethod
+    def from_document(cls, document: dict) -> Self:
+        model = cls.__new__(cls)
+        setters = cls._slot_setters
+        for name, value in document.items():
+            setters[name](model, value)
+        object.__setattr__(model, "_dirty", set())
+        return model
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if name not in self._allowed_vars:
+            raise ValueError(f"Invalid field provided: {name}")
+
+        if name != "_id" and getattr(self, name, _MISSING) != value:
+            self._dirty.add(name)
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name: str) -> None:
+        if name in self.required_vars or name == "_id":
+            raise ValueError(f"Cannot remove required field: {name}")
+        object.__delattr__(self, name)
+        self._dirty.add(name)
+
+    def to_document(self) -> dict:
+        document = {}
+        for name in self._fields:
+            value = getattr(self, name, _MISSING)
+            if value is not _MISSING:
+                document[name] = value
+        return document
+
+
+def build_model_class(model_name: str, required_vars: set[str], admissible_vars: set[str],
+                      db_collection: Collection | None = None, slots: bool = False, base: type | None = None) -> type:
+    """
+    Creates the class of a model with its field sets precomputed.
+
+    Parameters
+    ----------
+    model_name : str
+    name of the model class
+    required_vars : set[str]
+    Set of variables required by the model
+    admissible_vars : set[str]
+    Set of variables allowed by the model
+    db_collection : pymongo.collection.Collection | None
+    Connection to the database collection.
+    slots : bool
+    store the fields in __slots__ instead of a per-instance __dict__
+    base : type | None
+    subclass of Model to derive from, such as AsyncModel, Model by default
+    Returns
+    -------
+    type
+    the new subclass of Model
+    """
+    base = base or Model
+    if slots:
+        fields = tuple(sorted(set(required_vars) | set(admissible_vars) | {"_id"}))
+        bases = (SlottedModel,) if base is Model else (base, SlottedModel)
+        model_class = type(model_name, bases, {"__slots__": fields, "_fields": fields})
+        model_class._slot_setters = {name: model_class.__dict__[name].__set__ for name in fields}
+    else:
+        model_class = type(model_name, (base,), {})
+    model_class.init_class(db_collection=db_collection, required_vars=required_vars, admissible_vars=admissible_vars)
+    return model_class
+
+
+class ClientRegistry:
+    """
+    MongoDB clients shared by uri and pool options, so that every
+    initApp or ModelRegistry for the same server reuses one connection
+    pool. After a fork, the child process discards the clients inherited
+    from its parent and the model classes of the registries using them are
+    bound to new clients. Models given a collection by hand are not, they
+    must be declared again in the child.
+
+    Attributes
+    ----------
+    default_options : dict
+    pool options used when they are not given to get
+    """
+    default_options = {
+        "maxPoolSize": 100,
+        "minPoolSize": 0,
+        "connectTimeoutMS": 10_000,
+        "serverSelectionTimeoutMS": 10_000,
+        "socketTimeoutMS": None,
+    }
+
+    def __init__(self):
+        self._clients: dict[tuple, pymongo.MongoClient] = {}
+        self._lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._discard)
+
+    def get(self, uri: str = "mongodb://localhost:27017/", **options) -> pymongo.MongoClient:
+        """
+        Returns the client for the uri and options, creating it the first
+        time. Options not given take the value of default_options.
+        """
+        options = {**self.default_options, **options}
+        key = (uri, tuple(sorted(options.items())))
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = pymongo.MongoClient(uri, **options)
+            return self._clients[key]
+
+    def close_all(self) -> None:
+        """
+        Closes every client, the next get creates new ones.
+        """
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        for client in clients.values():
+            client.close()
+
+    def _discard(self) -> None:
+        # The sockets belong to the parent process, they must not be used or closed here
+        inherited, self._clients = self._clients, {}
+        self._lock = threading.Lock()
+        keys = {id(client): key for key, client in inherited.items()}
+
+        def new_client(client):
+            uri, options = keys[id(client)]
+            return self.get(uri, **dict(options))
+
+        for registry in list(_model_registries):
+            if id(registry.db.client) in keys:
+                registry.db = _rebound_database(registry.db, new_client(registry.db.client))
+        # The classes are rebound themselves, they outlive the registry when exported as globals
+        for model_class in list(_registered_models):
+            if id(model_class.db.database.client) in keys:
+                model_class.db = _rebound_collection(model_class.db, new_client(model_class.db.database.client))
+
+
+def _rebound_database(database, client):
+    # The same database on another client, with the same options
+    return client.get_database(database.name, codec_options=database.codec_options,
+                               read_preference=database.read_preference, write_concern=database.write_concern,
+                               read_concern=database.read_concern)
+
+
+def _rebound_collection(collection, client):
+    # The same collection on another client, with the same options
+    return _rebound_database(collection.database, client).get_collection(
+        collection.name, codec_options=collection.codec_options, read_preference=collection.read_preference,
+        write_concern=collection.write_concern, read_concern=collection.read_concern
+    )
+
+
+# Registries and model classes bound to new clients after a fork, see ClientRegistry
+_model_registries: weakref.WeakSet = weakref.WeakSet()
+_registered_models: weakref.WeakSet = weakref.WeakSet()
+
+mongo_clients = ClientRegistry()
+
+
+class ModelRegistry:
+    """
+    Model classes of one database, declared from a definitions file.
+    Several registries can be used in the same process, for example one
+    per database or tenant, and they share the MongoDB client of their
+    server. The classes are accessed by name: registry.Purchase,
+    registry["Purchase"] or registry.get("Purchase").
+
+    Attributes
+    ----------
+    db : pymongo.database.Database
+    database of the model collections
+    cache : redis.Redis | None
+    cache of the model classes of this registry, if None they use Model.cache
+    base : type
+    class the model classes derive from
+    models : dict[str, type]
+    model classes by name
+    definitions : dict
+    model definitions read from the definitions file
+    """
+
+    def __init__(self, db, cache=None, base: type | None = None):
+        self.db = db
+        self.cache = cache
+        self.base = base or Model
+        self.models: dict[str, type] = {}
+        self.definitions: dict = {}
+        _model_registries.add(self)
+
+    def load(self, definitions_path: str, slots: bool | None = None) -> Self:
+        """
+        Declares the model classes of the definitions file and creates
+        their declared indexes.
+
+        Parameters
+        ----------
+        definitions_path : str
+        path to the model definitions file
+        slots : bool | None
+        store the fields of every model in __slots__, if None the
+        optional "slots" entry of each model definition is used
+        """
+        self.declare(definitions_path, slots=slots)
+        for model_name, model_info in self.definitions.items():
+            # Create the declared indexes that do not exist yet
+            if model_info.get('indexes'):
+                report = self.models[model_name].ensure_indexes(model_info['indexes'])
+                for status in ('created', 'conflicting', 'undeclared', 'unused'):
+                    if report[status]:
+                        logger.info("%s indexes %s: %s", model_name, status, ", ".join(report[status]))
+        return self
+
+    def declare(self, definitions_path: str, slots: bool | None = None) -> Self:
+        """
+        Declares the model classes of the definitions file, without
+        creating their indexes.
+        """
+        with open(definitions_path, "r") as file:
+            models_definitions = yaml.safe_load(file)
+        for model_name, model_info in models_definitions.items():
+            # Extract required and admissible variables from the YAML file
+            required_vars = set(model_info['required_vars'])
+            admissible_vars = set(model_info['admissible_vars'])
+
+            # Dynamically create and initialize the model classes with the
+            # appropriate collection and variables
+            self.models[model_name] = build_model_class(
+                model_name, required_vars, admissible_vars,
+                db_collection=self.db[model_name.lower()],
+                slots=model_info.get('slots', False) if slots is None else slots,
+                base=self.base
+            )
+            if self.cache is not None:
+                self.models[model_name].cache = self.cache
+            _registered_models.add(self.models[model_name])
+
+        # References are linked once every class exists
+        for model_name, model_info in models_definitions.items():
+            self.models[model_name].references = {
+                field: (self.models[reference['model']], reference.get('field', 'name'))
+                for field, reference in model_info.get('references', {}).items()
+            }
+        self.definitions = models_definitions
+        return self
+
+    def get(self, name: str, default=None) -> type | None:
+        return self.models.get(name, default)
+
+    def __getitem__(self, name: str) -> type:
+        return self.models[name]
+
+    def __getattr__(self, name: str) -> type:
+        try:
+            return self.__dict__["models"][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.models
+
+    def __iter__(self):
+        return iter(self.models)
 
-        # Remove document-to-query association
-        self.cache.delete(f"doc:{self._id}:queries")
 
 class ModelCursor:
     """
@@ -250,14 +3158,27 @@ class ModelCursor:
     cursor : pymongo.cursor.Cursor
     pymongo cursor to iterate over
 
+    raw : bool
+    whether the documents are returned as plain dicts
+    partial : bool
+    whether the documents only contain some fields (projected query)
+    loader : ReferenceLoader | None
+    loader attached to every page of models, see resolve_references
+
     Methods
     -------
     __iter__() -> Generator
     Returns an iterator that iterates over the cursor elements
     and returns the documents as model objects.
+    iter_batches(n: int) -> Generator
+    Returns an iterator over lists of at most n models.
+    batch_size(n: int), sort(key, direction), limit(n: int) -> ModelCursor
+    Pass-through to the pymongo cursor, return the cursor itself.
+    resolve_references(loader, page_size) -> ModelCursor
+    Loads the references of the models page by page.
     """
 
-    def __init__(self, model_class: Model, cursor: pymongo.cursor.Cursor):
+    def __init__(self, model_class: Model, cursor: pymongo.cursor.Cursor, raw: bool = False, partial: bool = False):
         """
         Initializes the cursor with the pymongo model class and cursor
 
@@ -267,9 +3188,54 @@ class ModelCursor:
         Class to create the models of the documents being iterated over.
         cursor: pymongo.cursor.Cursor
         Pymongo cursor to iterate
+        raw : bool
+        yield the documents as plain dicts instead of model objects
+        partial : bool
+        the documents are projected, models are built without checking
+        the required variables
         """
         self.model = model_class
         self.cursor = cursor
+        self.raw = raw
+        self.partial = partial
+        self.loader = None
+        self.page_size = 100
+
+    def batch_size(self, batch_size: int) -> Self:
+        self.cursor.batch_size(batch_size)
+        return self
+
+    def sort(self, key_or_list, direction=None) -> Self:
+        self.cursor.sort(key_or_list, direction)
+        return self
+
+    def limit(self, limit: int) -> Self:
+        self.cursor.limit(limit)
+        return self
+
+    def resolve_references(self, loader: ReferenceLoader | None = None, page_size: int = 100) -> Self:
+        """
+        Groups the models in pages of page_size and attaches a loader to
+        each page, so reading a reference with Model.ref loads that
+        reference for the whole page with one query per referenced model.
+        Pass the loader of the request to share the loaded models with
+        other cursors.
+        """
+        if self.raw:
+            raise ValueError("References cannot be resolved on raw documents.")
+        self.loader = loader or ReferenceLoader()
+        self.page_size = page_size
+        return self
+
+    def _hydrate(self, document: dict):
+        if self.raw:
+            return document
+        if self.partial:
+            return self.model.from_document(document)
+        # Validated by the constructor, but unchanged since it was read
+        model = self.model(**document)
+        model._dirty.clear()
+        return model
 
     def __iter__(self) -> Generator:
         """
@@ -279,15 +3245,42 @@ class ModelCursor:
         Use the next function to get the next document from the cursor
         Use alive to check if there are more documents.
         """
+        if self.raw:
+            yield from self.cursor
+            return
+        if self.loader is not None:
+            for batch in self.iter_batches(self.page_size):
+                yield from batch
+            return
         for document in self.cursor:
-            yield self.model(**document)
+            yield self._hydrate(document)
+
+    def iter_batches(self, n: int) -> Generator:
+        """
+        Returns an iterator over lists of at most n models (or dicts in raw
+        mode), fetching n documents from the server per round-trip.
+        """
+        self.cursor.batch_size(n)
+        documents = iter(self.cursor)
+        while batch := list(islice(documents, n)):
+            if self.raw:
+                yield batch
+                continue
+            models = [self._hydrate(document) for document in batch]
+            if self.loader is not None:
+                self.loader.attach(models)
+            yield models
         
 
-    def initApp(definitions_path: str = "./models.yml", mongodb_uri="mongodb://localhost:27017/", db_name="abd") -> None:
+    def initApp(definitions_path: str = "./models.yml", mongodb_uri="mongodb://localhost:27017/", db_name="abd",
+                slots: bool | None = None, export_globals: bool = True, **pool_options) -> "ModelRegistry":
         """
         Declare the classes that inherit from Model for each of the
         models in the collections defined in definitions_path.
         Initializes the model classes by providing the supported and required variables for each of them and the connection to the database collection.
+        The indexes declared in the "indexes" section of each model are created if missing.
+        The MongoDB client is shared by all the calls with the same uri
+        and pool options, calling initApp again does not reconnect.
 
         Parameters
         ----------
@@ -297,37 +3290,36 @@ class ModelCursor:
         database connection uri
         db_name : str
         database name
+        slots : bool | None
+        store the fields of every model in __slots__, if None the
+        optional "slots" entry of each model definition is used
+        export_globals : bool
+        also declare the model classes as globals of this module
+        pool_options
+        options of the MongoClient, see ClientRegistry
+        Returns
+        -------
+        ModelRegistry
+        registry with the model classes
         """
         #DONE
-        # Initialize database
-        client = pymongo.MongoClient(mongodb_uri)
-        db = client[db_name]
-        
+        # Initialize database, the client is reused between calls
+        db = mongo_clients.get(mongodb_uri, **pool_options)[db_name]
+
         #DONE
         # Declare as many model collection classes as exist in the database
-        # Read the model definition file to get the collections
-        # and the allowed and required variables for each of them.
-        # Example of model declaration for collection called MyModel 
-        with open(definitions_path, "r") as file:
-            models_definitions = yaml.safe_load(file)
+        registry = ModelRegistry(db)
+        registry.load(definitions_path, slots=slots)
         # Ignore the warning from Pylance about MyModel, it is unable to detect
-        # that the class has been declared in the previous line since it is done
-        # at runtime.
-        for model_name, model_info in models_definitions.items():
-            # Extract required and admissible variables from the YAML file
-            required_vars = set(model_info['required_vars'])
-            admissible_vars = set(model_info['admissible_vars'])
-
-            # Dynamically create model classes
-            globals()[model_name] = type(model_name, (Model,), {})
-            
-            # Initialize the model class with the appropriate collection and variables
-            globals()[model_name].init_class(db_collection=db[model_name.lower()], required_vars=required_vars, admissible_vars=admissible_vars)
-        return globals()
+        # that the classes are declared here since it is done at runtime.
+        if export_globals:
+            globals().update(registry.models)
+        return registry
     
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     
     # PROJECT 1
     print("\nInitializing models from models_product.yml...")
@@ -351,24 +3343,26 @@ if __name__ == '__main__':
     
    
     #I am using local data.json file for inserting data into my mongo db collections
-    data = load_data_from_json()
-    
-    for elem in data['customers']:
-        customer = Customer(
+    # Records are imported in batches, geocoding the addresses of each batch at once
+
+    def load_customers(records: list[dict]) -> list[Model]:
+        locations = geocode_many(
+            [elem[field] for elem in records for field in ('billing_addresses', 'shipping_addresses')]
+        )
+        return [Customer(
 
             name=elem['name'],
             billing_addresses=elem['billing_addresses'],
-            coordinates_billing_adresses = get_coordinates_as_dict(elem['billing_addresses']),
+            coordinates_billing_adresses = point_to_dict(locations[elem['billing_addresses']]),
             registration_date=elem['registration_date'],
             shipping_addresses=elem['shipping_addresses'],
-            coordinates_shipping_adresses = get_coordinates_as_dict(elem['shipping_addresses']),
+            coordinates_shipping_adresses = point_to_dict(locations[elem['shipping_addresses']]),
             payment_cards=elem['payment_cards'],
             last_access_date=elem['last_access_date']
-        )
-        customer.save()
+        ) for elem in records]
     
-    for elem in data['products']:
-        product = Product(
+    def load_products(records: list[dict]) -> list[Model]:
+        return [Product(
             name=elem['name'],
             supplier_product_code=elem['supplier_product_code'],
             price_without_vat=elem['price_without_vat'],
@@ -378,34 +3372,42 @@ if __name__ == '__main__':
             dimensions=elem['dimensions'],
             weight=elem['weight'],
             suppliers=elem['suppliers']
-        )
-        product.save()
+        ) for elem in records]
     
-    for elem in data['purchases']:
-        purchase = Purchase(
+    def load_purchases(records: list[dict]) -> list[Model]:
+        locations = geocode_many([elem['shipping_address'] for elem in records])
+        return [Purchase(
             products=elem['products'],
             customer=elem['customer'],
             purchase_price=elem['purchase_price'],
             purchase_date=elem['purchase_date'],
             shipping_address=elem['shipping_address'],
-            shipping_coordinates=get_coordinates_as_dict(elem['shipping_address'])
-        )
-        purchase.save()
+            shipping_coordinates=point_to_dict(locations[elem['shipping_address']])
+        ) for elem in records]
 
-    for elem in data['suppliers']:
-        supplier = Supplier(
+    def load_suppliers(records: list[dict]) -> list[Model]:
+        locations = geocode_many([elem['warehouse_addresses'] for elem in records])
+        return [Supplier(
             name=elem['name'],
             warehouse_addresses=elem['warehouse_addresses'],
-            warehouse_coordinates=get_coordinates_as_dict(elem['warehouse_addresses'])
-        )
-        supplier.save()
+            warehouse_coordinates=point_to_dict(locations[elem['warehouse_addresses']])
+        ) for elem in records]
+
+    import_json_file("data.json", {
+        'customers': load_customers,
+        'products': load_products,
+        'purchases': load_purchases,
+        'suppliers': load_suppliers,
+    }, checkpoint_path="data.json.checkpoint")
    
 
     # Export all collections
-    export_collection_to_json(Customer.db, "customer.json")
-    export_collection_to_json(Product.db, "product.json")
-    export_collection_to_json(Purchase.db, "purchase.json")
-    export_collection_to_json(Supplier.db, "supplier.json")
+    export_collections_to_json([
+        (Customer.db, "customer.json"),
+        (Product.db, "product.json"),
+        (Purchase.db, "purchase.json"),
+        (Supplier.db, "supplier.json"),
+    ])
     
     # Tests for each model
 
@@ -525,3 +3527,18 @@ if __name__ == '__main__':
     #Example
     #Q1_r = MyModel.aggregate(Q1)
 
+    # Supplier turnover of a day: optimize moves the $match ahead of the join
+    # and only fetches from Product the two fields read by $group
+    Q7_day = [
+        {"$lookup": {"from": "product", "localField": "products", "foreignField": "name", "as": "product_details"}},
+        {"$unwind": "$product_details"},
+        {"$match": {"purchase_date": "2024-05-27"}},
+        {"$group": {"_id": "$product_details.suppliers", "total_billing_volume": {"$sum": "$product_details.price_with_vat"}}},
+        {"$sort": {"total_billing_volume": -1}},
+        {"$limit": 3},
+    ]
+    for label, pipeline in (("original", Q7_day), ("optimized", optimize_pipeline(Q7_day))):
+        summary = _explain_summary(Purchase.explain("aggregate", pipeline))
+        print(f"Q7 of a day, {label} pipeline: {summary['docs_examined']} documents examined")
+    print(list(Purchase.aggregate(Q7_day, optimize=True)))
+
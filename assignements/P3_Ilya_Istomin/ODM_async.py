@@ -0,0 +1,333 @@
+from typing import Any, AsyncGenerator, Iterable, Self
+
+import redis.asyncio
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCursor
+from pymongo.errors import OperationFailure
+
+from bson import ObjectId
+
+from ODM import (Model, ModelCursor, ModelRegistry, ClientRegistry, _filter_fields, _normalize_id,
+                 optimize_pipeline, logger)
+
+# asyncio counterpart of the ODM: the model classes generated from the same
+# definitions file, with save, delete, find_by_id, find, scan and aggregate
+# as coroutines over Motor and redis.asyncio.
+
+
+def _blocking_only(*args, **kwargs) -> Any:
+    raise TypeError("This operation is only available on blocking models, not on AsyncModel.")
+
+
+class AsyncModel(Model):
+    """
+    Model whose database and cache operations are coroutines.
+    Fields, validation and dirty tracking work as in Model. The
+    collection is a Motor collection and the cache a redis.asyncio
+    client, set with initialize_cache.
+    """
+    __slots__ = ()
+    # Separate from Model.cache, which holds a blocking client
+    cache: redis.asyncio.Redis | None = None
+
+    @classmethod
+    async def initialize_cache(cls, cache_instance: redis.asyncio.Redis, codec=None) -> None:
+        """
+        Initializes the Redis cache with proper settings and, optionally,
+        the encoding of the cached documents.
+        """
+        cls.cache = cache_instance
+        if codec is not None:
+            cls.codec = codec
+        await cls.cache.config_set("maxmemory", "150mb")
+        await cls.cache.config_set("maxmemory-policy", "volatile-lru")
+
+    @classmethod
+    async def ensure_indexes(cls, indexes: list[dict]) -> dict[str, list[str]]:
+        """
+        Creates the declared indexes that do not exist yet, see
+        Model.ensure_indexes. Only the "created", "existed" and
+        "conflicting" entries of the report are filled.
+        """
+        information = await cls.db.index_information()
+        report = {"created": [], "existed": [], "conflicting": [], "undeclared": [], "unused": []}
+        for index in indexes:
+            keys = cls._index_keys(index["keys"])
+            options = {option: value for option, value in index.items() if option != "keys"}
+            name, mismatched = cls._existing_index(keys, options, information)
+            if name is not None:
+                if mismatched:
+                    logger.warning("Index %s on %s differs from its declaration in: %s",
+                                   name, cls.db.name, ", ".join(mismatched))
+                report["conflicting" if mismatched else "existed"].append(name)
+                continue
+            try:
+                report["created"].append(await cls.db.create_index(keys, **options))
+            except OperationFailure as error:
+                logger.warning("Could not create index %s on %s: %s", keys, cls.db.name, error)
+                report["conflicting"].append(options.get("name", str(keys)))
+        return report
+
+    @classmethod
+    async def find(cls, filter: dict[str, str | dict]) -> AsyncGenerator[dict, None]:
+        """
+        Yields the documents matching the filter, from the cache if the
+        query is cached. Use with async for.
+        """
+        if cls.cache is None:
+            raise ValueError("Cache has not been initialized. Use 'initialize_cache' first.")
+
+        cache_key = cls._find_cache_key(filter)
+        pipe = cls.cache.pipeline(transaction=False)
+        pipe.getex(cache_key, ex=86400)
+        pipe.get(cls._version_key())
+        cached_result, version = await pipe.execute()
+        if cached_result:
+            logger.debug("Returning results from cache for filter: %s", filter)
+            for document in cls.codec.decode(cached_result):
+                yield document
+            return
+
+        logger.debug("Query not in cache, querying MongoDB for filter: %s", filter)
+        results = await cls.db.find(filter).to_list(None)
+
+        index_keys = [f"doc:{document['_id']}:queries" for document in results]
+        field_keys = [cls._field_index_key(field) for field in _filter_fields(filter)]
+        await cls._cache_script("fill")(**cls._fill_args(
+            version, [cache_key], [cls.codec.encode(results)], 86400, index_keys + field_keys, len(field_keys)
+        ))
+
+        for document in results:
+            yield document
+
+    @classmethod
+    async def find_by_id(cls, id: str | ObjectId) -> dict | None:
+        """
+        Searches for a document by its id using the cache.
+        If the document is not found, fetches it from the database.
+        """
+        if cls.cache is None:
+            raise ValueError("Cache has not been initialized. Use 'initialize_cache' first.")
+
+        id = _normalize_id(id)
+        cache_key = cls._id_cache_key(id)
+        cached_data, version = await cls.cache.mget([cache_key, cls._version_key()])
+        if cached_data:
+            logger.debug("Returning cached data for ID %s", id)
+            return cls.codec.decode(cached_data)
+
+        document = await cls.db.find_one({'_id': id})
+        if document:
+            await cls._cache_script("fill")(**cls._fill_args(version, [cache_key], [cls.codec.encode(document)], 86400))
+        return document
+
+    @classmethod
+    async def find_by_ids(cls, ids: Iterable[str | ObjectId]) -> list[dict | None]:
+        """
+        Searches for several documents by their ids using the cache,
+        see Model.find_by_ids.
+        """
+        if cls.cache is None:
+            raise ValueError("Cache has not been initialized. Use 'initialize_cache' first.")
+
+        ids = [_normalize_id(id) for id in ids]
+        if not ids:
+            return []
+        cache_keys = [cls._id_cache_key(id) for id in ids]
+
+        *cached_values, version = await cls.cache.mget(cache_keys + [cls._version_key()])
+        documents = {}
+        misses = {}
+        for id, cache_key, cached_data in zip(ids, cache_keys, cached_values):
+            if cached_data is not None:
+                documents[cache_key] = cls.codec.decode(cached_data)
+            else:
+                misses[cache_key] = id
+
+        if misses:
+            found = {}
+            async for document in cls.db.find({'_id': {'$in': list(misses.values())}}):
+                found[cls._id_cache_key(document['_id'])] = document
+            if found:
+                await cls._cache_script("fill")(**cls._fill_args(
+                    version, list(found), [cls.codec.encode(document) for document in found.values()], 86400
+                ))
+            documents.update(found)
+        return [documents.get(cache_key) for cache_key in cache_keys]
+
+    @classmethod
+    def scan(cls, filter: dict[str, str | dict] | None = None, projection: dict | list | None = None,
+             sort: list | None = None, limit: int = 0, batch_size: int = 0, raw: bool = False) -> "AsyncModelCursor":
+        """
+        Performs an uncached read query and returns an AsyncModelCursor
+        over it, see Model.scan.
+        """
+        cursor = cls.db.find(filter or {}, projection, sort=sort, limit=limit, batch_size=batch_size)
+        return AsyncModelCursor(cls, cursor, raw=raw, partial=projection is not None)
+
+    @classmethod
+    async def aggregate(cls, pipeline: list[dict], cache: bool = False, ttl: int = 86400,
+                        optimize: bool = False) -> list[dict]:
+        """
+        Returns the documents of an aggregate query, see Model.aggregate.
+        With optimize, the pipeline is only rewritten by optimize_pipeline.
+        """
+        if optimize:
+            pipeline = optimize_pipeline(pipeline)
+        if not cache:
+            return await cls.db.aggregate(pipeline).to_list(None)
+        if cls.cache is None:
+            raise ValueError("Cache has not been initialized. Use 'initialize_cache' first.")
+        if any(stage_name in ("$out", "$merge") for stage in pipeline for stage_name in stage):
+            raise ValueError("Pipelines that write with $out or $merge cannot be cached.")
+
+        collections = cls._aggregate_collections(pipeline)
+        versions = await cls.cache.mget([cls._version_key(name) for name in collections])
+        cache_key = cls._aggregate_cache_key(pipeline, collections, versions)
+
+        cached_result = await cls.cache.get(cache_key)
+        if cached_result:
+            logger.debug("Returning aggregate results from cache for key: %s", cache_key)
+            return cls.codec.decode(cached_result)
+
+        results = await cls.db.aggregate(pipeline).to_list(None)
+        await cls.cache.setex(cache_key, ttl, cls.codec.encode(results))
+        return results
+
+    async def save(self) -> None:
+        """
+        Saves the model in the database, see Model.save.
+        """
+        if not hasattr(self, '_id'):
+            document = self.to_document()
+            result = await self.db.insert_one(document)
+            self._id = str(result.inserted_id)
+            changed_fields = set(document) - {"_id"}
+        else:
+            changes = self._changes()
+            if not changes:
+                return
+            previous = await self.db.find_one_and_update({'_id': _normalize_id(self._id)}, changes,
+                                                         projection={field: 1 for field in self._dirty})
+            changed_fields = self._changed_fields(previous)
+        self._dirty.clear()
+        await self.invalidate_cache(changed_fields)
+
+    async def delete(self) -> None:
+        """
+        Deletes the model from the database and invalidates cache.
+        """
+        if not hasattr(self, '_id'):
+            raise ValueError("Cannot delete a model without an ID.")
+
+        await self.db.delete_one({'_id': _normalize_id(self._id)})
+        await self.invalidate_cache()
+
+    async def invalidate_cache(self, fields: set[str] | None = None) -> None:
+        """
+        Invalidates the cached queries of this document and of the fields.
+        """
+        if self.cache is None:
+            raise ValueError("Cache has not been initialized. Use 'initialize_cache' first.")
+        if not hasattr(self, "_id"):
+            raise ValueError("Cannot invalidate cache for a model without an ID.")
+        await self.invalidate_cache_for_ids([self._id], fields)
+
+    @classmethod
+    async def invalidate_cache_for_ids(cls, doc_ids: list[str], fields: set[str] | None = None) -> None:
+        """
+        Invalidates the cached queries of several documents at once,
+        see Model.invalidate_cache_for_ids.
+        """
+        if cls.cache is None:
+            raise ValueError("Cache has not been initialized. Use 'initialize_cache' first.")
+        if not doc_ids:
+            return
+
+        await cls._cache_script("invalidate")(**cls._invalidate_args(doc_ids, fields))
+
+    # Blocking operations of Model without an async counterpart
+    save_many = update_many = delete_many = staticmethod(_blocking_only)
+    parallel_scan = explain = lint_pipeline = ref = staticmethod(_blocking_only)
+
+
+class AsyncModelCursor(ModelCursor):
+    """
+    Cursor over the documents of a Motor query, iterated with async for.
+    The documents are returned as model objects unless raw is given.
+    """
+
+    def __init__(self, model_class: type, cursor: AsyncIOMotorCursor, raw: bool = False, partial: bool = False):
+        super().__init__(model_class, cursor, raw=raw, partial=partial)
+
+    def __iter__(self):
+        raise TypeError("AsyncModelCursor must be iterated with async for.")
+
+    def resolve_references(self, *args, **kwargs) -> Self:
+        raise TypeError("References are not resolved on async cursors.")
+
+    async def __aiter__(self) -> AsyncGenerator:
+        async for document in self.cursor:
+            yield self._hydrate(document)
+
+    async def iter_batches(self, n: int) -> AsyncGenerator[list, None]:
+        """
+        Yields lists of at most n models (or dicts in raw mode), fetching
+        n documents from the server per round-trip.
+        """
+        self.cursor.batch_size(n)
+        while batch := await self.cursor.to_list(n):
+            yield batch if self.raw else [self._hydrate(document) for document in batch]
+
+
+class AsyncClientRegistry(ClientRegistry):
+    """
+    Motor clients shared by uri and pool options, see ClientRegistry.
+    """
+
+    def get(self, uri: str = "mongodb://localhost:27017/", **options) -> AsyncIOMotorClient:
+        options = {**self.default_options, **options}
+        key = (uri, tuple(sorted(options.items())))
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = AsyncIOMotorClient(uri, **options)
+            return self._clients[key]
+
+
+motor_clients = AsyncClientRegistry()
+
+
+async def initApp(definitions_path: str = "./models.yml", mongodb_uri="mongodb://localhost:27017/", db_name="abd",
+                  slots: bool | None = None, cache: redis.asyncio.Redis | None = None, **pool_options) -> ModelRegistry:
+    """
+    Declares the async model classes of the definitions file, see
+    ModelCursor.initApp, and creates their declared indexes.
+
+    Parameters
+    ----------
+    definitions_path : str
+    path to the model definitions file
+    mongodb_uri : str
+    database connection uri
+    db_name : str
+    database name
+    slots : bool | None
+    store the fields of every model in __slots__, if None the
+    optional "slots" entry of each model definition is used
+    cache : redis.asyncio.Redis | None
+    cache of the model classes, if None they use AsyncModel.cache
+    pool_options
+    options of the Motor client, see ClientRegistry
+    Returns
+    -------
+    ModelRegistry
+    registry with the async model classes
+    """
+    db = motor_clients.get(mongodb_uri, **pool_options)[db_name]
+    registry = ModelRegistry(db, cache=cache, base=AsyncModel).declare(definitions_path, slots=slots)
+    for model_name, model_info in registry.definitions.items():
+        if model_info.get('indexes'):
+            report = await registry[model_name].ensure_indexes(model_info['indexes'])
+            for status in ('created', 'conflicting'):
+                if report[status]:
+                    logger.info("%s indexes %s: %s", model_name, status, ", ".join(report[status]))
+    return registry
@@ -0,0 +1,74 @@
+import json
+import timeit
+from datetime import datetime, timedelta
+
+import redis
+from bson import ObjectId
+
+from ODM import BSONCodec, JSONCodec
+
+# Cache encoding benchmark: compares the JSON encoding used before with
+# BSON, with and without compression, on find results shaped like the
+# documents of data.json as they are read from MongoDB.
+
+REPEAT = 5
+RESULT_SIZES = [1, 100, 5000]
+
+with open("./data.json", "r") as file:
+    data = json.load(file)
+
+purchases = data["purchases"]
+
+codecs = [
+    ("json", JSONCodec()),
+    ("bson", BSONCodec(compress_threshold=None)),
+    ("bson+zlib >16KiB", BSONCodec()),
+]
+
+
+def result_set(size: int) -> list[dict]:
+    # Documents as returned by pymongo, with an ObjectId and a creation datetime.
+    # data.json only has a few purchases, prices vary so that they do not repeat.
+    return [
+        {
+            "_id": ObjectId(),
+            **purchases[i % len(purchases)],
+            "purchase_price": round(purchases[i % len(purchases)]["purchase_price"] * (1 + i / 997), 2),
+            "created_at": datetime(2024, 1, 1) + timedelta(seconds=37 * i),
+        }
+        for i in range(size)
+    ]
+
+
+def timing_us(function, number: int) -> float:
+    return min(timeit.Timer(function).repeat(repeat=REPEAT, number=number)) / number * 1e6
+
+
+def redis_memory(cache: redis.Redis | None, value: bytes) -> int | None:
+    if cache is None:
+        return None
+    cache.set("benchmark:codec", value)
+    memory = cache.memory_usage("benchmark:codec")
+    cache.delete("benchmark:codec")
+    return memory
+
+
+if __name__ == "__main__":
+    try:
+        cache = redis.Redis(host="localhost", port=6379, db=0)
+        cache.ping()
+    except redis.ConnectionError:
+        print("Redis is not available, memory usage is not measured\n")
+        cache = None
+
+    print(f"{'documents':>10}  {'codec':<18}{'encode us':>12}{'decode us':>12}{'bytes':>12}{'redis bytes':>14}")
+    for size in RESULT_SIZES:
+        results = result_set(size)
+        number = max(1, 20_000 // size)
+        for name, codec in codecs:
+            encoded = codec.encode(results)
+            encode = timing_us(lambda: codec.encode(results), number)
+            decode = timing_us(lambda: codec.decode(encoded), number)
+            memory = redis_memory(cache, encoded)
+            memory = f"{memory:,}" if memory is not None else "-"
+            print(f"{size:>10}  {name:<18}{encode:>12,.1f}{decode:>12,.1f}{len(encoded):>12,}{memory:>14}")
@@ -0,0 +1,76 @@
+import timeit
+import tracemalloc
+
+import yaml
+
+from ODM import build_model_class
+
+# Model construction micro-benchmark: compares the previous Model.__init__,
+# which built three sets per instance, with the classes generated by
+# build_model_class, with and without __slots__.
+
+N = 100_000
+REPEAT = 5
+
+with open("./models_product.yml", "r") as file:
+    purchase_definition = yaml.safe_load(file)["Purchase"]
+
+required_vars = set(purchase_definition["required_vars"])
+admissible_vars = set(purchase_definition["admissible_vars"])
+
+purchase_document = {
+    "products": ["Tablet", "Smartwatch", "Air Conditioner"],
+    "customer": "Thomas Mills",
+    "purchase_price": 471.64,
+    "purchase_date": "2024-05-27",
+    "shipping_address": "Carrer de Mallorca, 401, 08013 Barcelona, Spain",
+    "shipping_coordinates": {"longitude": 2.1744, "latitude": 41.4035},
+}
+
+
+class LegacyPurchase:
+    """
+    Copy of the Model.__init__ used before the classes were generated.
+    """
+    required_vars = required_vars
+    admissible_vars = admissible_vars
+
+    def __init__(self, **kwargs):
+        allowed_vars = self.required_vars | self.admissible_vars | {"_id"}
+
+        missing_vars = self.required_vars - set(kwargs.keys())
+        if missing_vars:
+            raise ValueError(f"Missing required variables: {missing_vars}")
+
+        invalid_vars = set(kwargs.keys()) - allowed_vars
+        if invalid_vars:
+            raise ValueError(f"Invalid fields provided: {invalid_vars}")
+
+        self.__dict__.update(kwargs)
+        self.__dict__["_dirty"] = set()
+
+
+Purchase = build_model_class("Purchase", required_vars, admissible_vars)
+SlottedPurchase = build_model_class("SlottedPurchase", required_vars, admissible_vars, slots=True)
+
+
+def construction_rate(model_class: type) -> float:
+    timer = timeit.Timer(lambda: model_class(**purchase_document))
+    best = min(timer.repeat(repeat=REPEAT, number=N))
+    return N / best
+
+
+def memory_per_instance(model_class: type) -> float:
+    tracemalloc.start()
+    instances = [model_class(**purchase_document) for _ in range(N)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del instances
+    return size / N
+
+
+if __name__ == "__main__":
+    print(f"Constructing {N} Purchase models, best of {REPEAT} runs\n")
+    print(f"{'class':<20}{'models/s':>14}{'bytes/model':>14}")
+    for name, model_class in [("legacy", LegacyPurchase), ("generated", Purchase), ("generated, slots", SlottedPurchase)]:
+        print(f"{name:<20}{construction_rate(model_class):>14,.0f}{memory_per_instance(model_class):>14,.0f}")
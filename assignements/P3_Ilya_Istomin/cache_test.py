@@ -1,5 +1,5 @@
 import redis
-from ODM import ModelCursor
+from ODM import ModelCursor, optimize_pipeline, _explain_summary
 import json
 
 # Redis settings for the cache (db=0)
@@ -64,11 +64,11 @@ def cleanup_test_data():
     """Removes all test data."""
     print("\nCleaning up test data...")
     
-    # Delete only test data from database
-    Customer.db.delete_many({"name": {"$regex": "^Test"}})
-    Product.db.delete_many({"name": {"$regex": "^Test"}})
-    Supplier.db.delete_many({"name": {"$regex": "^Test"}})
-    Purchase.db.delete_many({"purchase_date": {"$regex": "^2024-01"}})
+    # Delete only test data from database, invalidating their cached queries
+    Customer.delete_many({"name": {"$regex": "^Test"}})
+    Product.delete_many({"name": {"$regex": "^Test"}})
+    Supplier.delete_many({"name": {"$regex": "^Test"}})
+    Purchase.delete_many({"purchase_date": {"$regex": "^2024-01"}})
 
     # Clear Redis cache
     cache_db.flushdb()
@@ -83,9 +83,9 @@ def test_cache_behavior():
     print(f"Number of customers retrieved: {len(customers)}")
     assert len(customers) == 2, "Expected 2 customers"
 
-    # Generate cache key the same way it is generated in the find method
+    # Generate cache key the same way it is generated in the find method, scoped by database and collection
     filter_key = {"name": {"$regex": "^Test Customer"}}
-    cache_key = f"find:{json.dumps(filter_key, sort_keys=True)}"
+    cache_key = f"find:{db_name}.{Customer.db.name}:{json.dumps(filter_key, sort_keys=True)}"
     assert cache_db.exists(cache_key), "Customer query should be cached"
 
     # Update a customer and invalidate cache
@@ -101,7 +101,7 @@ def test_cache_behavior():
     print(f"Number of products retrieved: {len(products)}")
     assert len(products) == 2, "Expected 2 products"
 
-    cache_key = f"find:{json.dumps({'name': {'$regex': '^Test Product'}}, sort_keys=True)}"
+    cache_key = f"find:{db_name}.{Product.db.name}:{json.dumps({'name': {'$regex': '^Test Product'}}, sort_keys=True)}"
     assert cache_db.exists(cache_key), "Product query should be cached"
 
     # Delete a product and check cache invalidation
@@ -116,7 +116,7 @@ def test_cache_behavior():
     print(f"Number of purchases retrieved: {len(purchases)}")
     assert len(purchases) == 2, "Expected 2 purchases"
 
-    cache_key = f"find:{json.dumps({'purchase_date': {'$regex': '^2024-01'}}, sort_keys=True)}"
+    cache_key = f"find:{db_name}.{Purchase.db.name}:{json.dumps({'purchase_date': {'$regex': '^2024-01'}}, sort_keys=True)}"
     assert cache_db.exists(cache_key), "Purchase query should be cached"
 
     # Delete a purchase and check cache invalidation
@@ -131,7 +131,7 @@ def test_cache_behavior():
     print(f"Number of suppliers retrieved: {len(suppliers)}")
     assert len(suppliers) == 2, "Expected 2 suppliers"
 
-    cache_key = f"find:{json.dumps({'name': {'$regex': '^Test Supplier'}}, sort_keys=True)}"
+    cache_key = f"find:{db_name}.{Supplier.db.name}:{json.dumps({'name': {'$regex': '^Test Supplier'}}, sort_keys=True)}"
     assert cache_db.exists(cache_key), "Supplier query should be cached"
 
     # Delete a supplier and check cache invalidation
@@ -161,8 +161,8 @@ def test_intersecting_queries():
     customers_group_2 = Customer.find(query_2)
 
     # Generate cache keys
-    cache_key_1 = f"find:{json.dumps(query_1, sort_keys=True)}"
-    cache_key_2 = f"find:{json.dumps(query_2, sort_keys=True)}"
+    cache_key_1 = f"find:{db_name}.{Customer.db.name}:{json.dumps(query_1, sort_keys=True)}"
+    cache_key_2 = f"find:{db_name}.{Customer.db.name}:{json.dumps(query_2, sort_keys=True)}"
 
     # Ensure both queries are cached
     assert cache_db.exists(cache_key_1), "Query 1 should be cached"
@@ -201,8 +201,8 @@ def test_complex_cache_behavior():
     customers_subset = Customer.find(query_subset)
 
     # Generate cache keys
-    cache_key_all = f"find:{json.dumps(query_all, sort_keys=True)}"
-    cache_key_subset = f"find:{json.dumps(query_subset, sort_keys=True)}"
+    cache_key_all = f"find:{db_name}.{Customer.db.name}:{json.dumps(query_all, sort_keys=True)}"
+    cache_key_subset = f"find:{db_name}.{Customer.db.name}:{json.dumps(query_subset, sort_keys=True)}"
 
     # Ensure both queries are cached
     assert cache_db.exists(cache_key_all), "Query covering all customers should be cached"
@@ -224,7 +224,7 @@ def test_complex_cache_behavior():
 
     # Re-query and cache
     customers_all = Customer.find(query_all)
-    cache_key_all = f"find:{json.dumps(query_all, sort_keys=True)}"
+    cache_key_all = f"find:{db_name}.{Customer.db.name}:{json.dumps(query_all, sort_keys=True)}"
     assert cache_db.exists(cache_key_all), "Query covering all customers should be cached after re-query"
 
     # Step 5: Delete Test4 and verify cache invalidation
@@ -236,11 +236,40 @@ def test_complex_cache_behavior():
     assert not cache_db.exists(cache_key_all), "Query covering all customers should have been invalidated after deletion"
     print("Complex cache behavior test passed successfully.")
 
+def test_optimized_aggregate():
+    """Test that optimize_pipeline reduces the documents examined by an aggregate."""
+    print("\nTesting optimized aggregate...")
+
+    # The $match on the purchase is placed after the join, so every purchase is joined
+    pipeline = [
+        {"$lookup": {"from": "product", "localField": "products", "foreignField": "name", "as": "product_details"}},
+        {"$unwind": "$product_details"},
+        {"$match": {"purchase_date": "2024-01-10"}},
+        {"$group": {"_id": "$customer", "total": {"$sum": "$product_details.price_with_vat"}}},
+    ]
+    original = _explain_summary(Purchase.explain("aggregate", pipeline))
+    optimized = _explain_summary(Purchase.explain("aggregate", optimize_pipeline(pipeline)))
+    print(f"Documents examined: {original['docs_examined']} original, {optimized['docs_examined']} optimized")
+    assert optimized["docs_examined"] < original["docs_examined"], "The optimized pipeline should examine fewer documents"
+
+    # Same result with the optimized pipeline
+    expected = sorted(map(str, Purchase.aggregate(pipeline)))
+    assert sorted(map(str, Purchase.aggregate(pipeline, optimize=True))) == expected, "Optimizing should not change the result"
+
+    # The joined products are in the output, they must be returned whole
+    pipeline = pipeline[:3] + [{"$sort": {"product_details.price_with_vat": 1}}]
+    expected = [str(purchase) for purchase in Purchase.aggregate(pipeline)]
+    assert expected, "The purchase of the day should be returned"
+    assert [str(purchase) for purchase in Purchase.aggregate(pipeline, optimize=True)] == expected, \
+        "Optimizing should not change the joined documents of the result"
+    print("Optimized aggregate test passed successfully.")
+
 if __name__ == "__main__":
     try:
         setup_test_data()
         test_cache_behavior()
         test_intersecting_queries()
         test_complex_cache_behavior()
+        test_optimized_aggregate()
     finally:
         cleanup_test_data()
\ No newline at end of file